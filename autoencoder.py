@@ -2,9 +2,6 @@ import numpy as np
 import deepnet
 import backprop
 import cPickle as pickle
-import scipy.io
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
 
 def demo_autoencoder():
     #load and norm the data
@@ -26,17 +23,24 @@ def demo_autoencoder():
     ##save
     pickle.dump(trained, file('network.pkl','wb'))
 
-def unroll_network(network):
+def unroll_network(network, tied=False):
     '''
     Takes a pre-trained network and treats it as an encoder network. The decoder
     network is constructed by inverting the encoder. The decoder is then appended
     to the input network to produce an autoencoder.
+
+    If tied is True, the decoder layers share the weights of the encoder layers
+    (backprop.TiedLayer) instead of copying them, which halves the parameters
+    that backprop has to store and optimize.
     '''
     decoder = []
     encoder = []
     for i in range(len(network)):
         elayer = backprop.Layer(network[i].W.T, network[i].hbias, network[i].n_hidden, network[i].hidtype)
-        dlayer = backprop.Layer(network[i].W, network[i].vbias, network[i].n_visible, network[i].vistype)
+        if tied:
+            dlayer = backprop.TiedLayer(elayer, network[i].vbias, network[i].n_visible, network[i].vistype)
+        else:
+            dlayer = backprop.Layer(network[i].W, network[i].vbias, network[i].n_visible, network[i].vistype)
         encoder.append(elayer)
         decoder.append(dlayer)
     decoder.reverse()
@@ -48,6 +52,7 @@ def save_net_as_mat(pickled_net):
     Takes the network pickle file saved in demo_autoencoder and saves it as a .mat
     file for use with matlab
     '''
+    import scipy.io
     network = pickle.load(file(pickled_net,'rb'))
     mdic = {}
     for i in range(len(network)/2):
@@ -57,6 +62,8 @@ def save_net_as_mat(pickled_net):
     scipy.io.savemat('network.mat', mdic)
 
 def visualize_results(netfile, datafile):
+    import matplotlib.pyplot as plt
+    import matplotlib.cm as cm
     network = pickle.load(file(netfile, 'rb'))
     #network = unroll_network(dnn.network)
     data = np.load(datafile)
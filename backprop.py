@@ -1,12 +1,13 @@
-import sys
-import os
-home = os.path.expanduser("~")
-sys.path.append(os.path.join(home, 'gnumpy'))
-import gnumpy as gp
 import numpy as np
-import scipy
-import scipy.optimize
+import time
+import lazy
 import deepnet
+import events
+import memplan
+import splitdata
+import transfers
+# gnumpy is imported the first time it is used
+gp = lazy.gnumpy
 
 class NeuralNet(object):
     '''
@@ -16,13 +17,27 @@ class NeuralNet(object):
     variables containing numpy arrays, n_hidden containing the number of 
     hidden units, and hidtype containing a string with the activation type, i.e.
     "sigmoid".
+
+    The memplan.MemoryPlanner given as planner sizes the inference blocks and
+    backprop batches, default memplan.default_planner(). Random weights are
+    drawn from rng, an int seed or a numpy RandomState, default the global
+    numpy random state.
     '''
-    def __init__(self, network=None, layer_sizes=None, layer_types=None):
+    def __init__(self, network=None, layer_sizes=None, layer_types=None, planner=None,
+            rng=None):
+        self.planner = planner
         layers = []
         if (network != None):
-            # copy the weights from the given network onto the GPU
+            # copy the weights from the given network onto the GPU. A TiedLayer
+            # is tied to the copy of its layer, so the weights stay shared
+            copies = {}
             for rbm in network:
-                l = Layer(rbm.W, rbm.hbias, rbm.n_hidden, rbm.hidtype)
+                if isinstance(rbm, TiedLayer) and (id(rbm.tied) in copies):
+                    l = TiedLayer(copies[id(rbm.tied)], rbm.hbias, rbm.n_hidden,
+                            rbm.hidtype)
+                else:
+                    l = Layer(rbm.W, rbm.hbias, rbm.n_hidden, rbm.hidtype)
+                copies[id(rbm)] = l
                 layers.append(l)
         else:
             # if no pre-trained network is given, initialize random weights
@@ -37,15 +52,10 @@ class NeuralNet(object):
                 n += layer_sizes[i]*layer_sizes[i+1]
                 n += layer_sizes[i+1]
             bound = 2.38 / np.sqrt(n)
+            rng = deepnet.get_rng(rng)
             for i in range(len(layer_sizes)-1):
-                W = np.zeros((layer_sizes[i+1]*layer_sizes[i],))
-                for j in range(W.size):
-                    W[j] = np.random.uniform(-bound, bound)
-                W = W.reshape((layer_sizes[i+1], layer_sizes[i]))
-                hbias = np.zeros((layer_sizes[i+1],))
-                for j in range(hbias.size):
-                    hbias[j] = np.random.uniform(-bound, bound)
-                hbias = hbias.reshape((layer_sizes[i+1],1))
+                W = rng.uniform(-bound, bound, (layer_sizes[i+1], layer_sizes[i]))
+                hbias = rng.uniform(-bound, bound, (layer_sizes[i+1],1))
                 l = Layer(W, hbias, layer_sizes[i+1], layer_types[i+1])
                 layers.append(l)
         self.network = layers
@@ -65,9 +75,13 @@ class NeuralNet(object):
             net = self.network
         hid = data
         for layer in net:
-            vis = gp.garray(hid)
+            if isinstance(hid, splitdata.SplitData):
+                # get_activation moves the dense part to the gpu itself
+                vis = hid
+            else:
+                vis = transfers.to_device(hid, 'NeuralNet.run_through_network')
             hid = self.get_activation(layer, vis)
-            gp.free_reuse_cache()
+            transfers.free_cache('NeuralNet.run_through_network')
         return hid
 
     def get_activation(self, layer, data):
@@ -76,28 +90,38 @@ class NeuralNet(object):
 
         args:
             obj layer:  the layer object 
-            array data: the input data
+            array data: the input data, may be a splitdata.SplitData
         returns:
             array hid:  the output of the layer
         '''
         if not hasattr(layer, 'n_hidden'):
             layer = layer[0]
         hid = np.zeros((data.shape[0], layer.n_hidden))
-        breaks = range(0, hid.shape[0], 128)
+        planner = memplan.get_planner(getattr(self, 'planner', None))
+        block = planner.block_rows(layer.W.shape[1], layer.n_hidden, hid.shape[0])
+        breaks = range(0, hid.shape[0], block)
         breaks.append(hid.shape[0])
+        split = isinstance(data, splitdata.SplitData)
+        if split:
+            W = layer.W.T
+            # the sparse rows of the weights are copied to the host once
+            Wc = transfers.to_host(W[data.n_dense:], 'NeuralNet.get_activation')
         for i in range(len(breaks)-1):
             s = breaks[i]
             e = breaks[i+1]
-            act = gp.dot(data[s:e], layer.W.T) + layer.hbias.T
+            if split:
+                act = deepnet.split_dot(data[s:e], W, Wc) + layer.hbias.T
+            else:
+                act = gp.dot(data[s:e], layer.W.T) + layer.hbias.T
             if layer.hidtype == 'sigmoid':
-                hid[s:e] = (act.logistic()).as_numpy_array()
+                hid[s:e] = transfers.to_host(act.logistic(), 'NeuralNet.get_activation')
             else:
-                hid[s:e] = act.as_numpy_array()
+                hid[s:e] = transfers.to_host(act, 'NeuralNet.get_activation')
         return hid
 
     def train(self, network, data, targets, validX=None, validT=None, max_iter=100,
             validErrFunc='classification', targetCost='linSquaredErr', initialfit=5,
-            cg_iter=20):
+            cg_iter=20, callbacks=None, batch_size=None):
         '''
         Trains the network using backprop
 
@@ -117,7 +141,12 @@ class NeuralNet(object):
             int initialfit: if n>0, top layer only will be trained for n iterations
             int cg_iter:    the max number of iterations for conjugate gradient
                             optimization, default=20
+            list callbacks: objects that receive the training events, see 
+                            events.Callback. Default prints progress, [] is silent
+            int batch_size: the backprop batch size, default 1024 or as many
+                            rows as fit in the memory planner's budget
         '''
+        emitter = events.emitter(callbacks)
         # initialize parameteres
         self.validErrFunc = validErrFunc
         self.targetCost = targetCost
@@ -128,7 +157,11 @@ class NeuralNet(object):
             numunits = numunits + self.network[i].W.shape[1] + \
                     self.network[i].hbias.shape[0]
         self.numunits = numunits
-        self.batch_size = 1024
+        if batch_size is None:
+            layer_sizes = [network[0].W.shape[1]] + [l.n_hidden for l in network]
+            planner = memplan.get_planner(getattr(self, 'planner', None))
+            batch_size = planner.batch_size(layer_sizes, self.n)
+        self.batch_size = batch_size
         self.weights = np.ones((self.n,1))
         
         # For estimating test error
@@ -137,39 +170,52 @@ class NeuralNet(object):
         tinds = tindex[:(np.min([self.batch_size, self.n]))]
         
         # Perform gradient descent
-        print "Starting %d iterations of backprop." % max_iter
+        emitter.emit('start', network, max_iter=max_iter)
         if (initialfit>0):  
             # This gets the activation of next to last layer to train top layer 
             transformedX = self.run_through_network(data, network[:-1])
+        if max_iter == 0:
+            # the loop reports the errors after every iteration, so they are
+            # only computed up front for the final event when it doesn't run
+            errs = self.getErrors(network, data[tinds,:], targets[tinds,:],
+                    self.weights[tinds], validX, validT)
         for i in range(max_iter):
-            trainerr = self.getError(network, data[tinds,:], targets[tinds,:],
-                    self.weights[tinds])
-            if validX is not None:
-                validerr = self.getError(network, validX, validT, 
-                        np.ones((validX.shape[0],)))
-                print "Iteration %3d: TrainErr = %4.3f, ValidErr = %4.3f" % \
-                        (i+1, trainerr, validerr)
-            else:
-                print "Iteration %3d: TrainErr = %4.3f" %(i+1, trainerr)
+            iter_start = time.time()
             # Train the top layer only for initialfit iters
             if (i < initialfit):
-                toplayer = self.doBackprop(transformedX, targets, [network[-1]])
+                toplayer = self.doBackprop(transformedX, targets, [network[-1]],
+                        emitter)
                 network[-1] = toplayer[0]
             else:
-                network = self.doBackprop(data, targets, network)
+                network = self.doBackprop(data, targets, network, emitter)
+            seconds = time.time() - iter_start
+            errs = self.getErrors(network, data[tinds,:], targets[tinds,:],
+                    self.weights[tinds], validX, validT)
+            fields = transfers.fields('iteration')
+            fields.update(errs)
+            emitter.emit('iteration', network, iteration=i, max_iter=max_iter,
+                    seconds=seconds, rows=self.n, rows_per_sec=self.n/max(seconds, 1e-9),
+                    **fields)
+            if emitter.stop:
+                break
+
+        # Report the final training error
+        emitter.emit('final', network, **errs)
+
+        return network
+
+    def getErrors(self, network, X, T, weights, validX=None, validT=None):
+        '''
+        Calculates the training error, and the validation error if there is
+        validation data, as the train_error and valid_error entries of a dict
 
-        # Print the final training error
-        trainerr = self.getError(network, data[tinds,:], targets[tinds,:],
-                self.weights[tinds])
+        This function is designed to be called by the train() method
+        '''
+        errs = {'train_error': self.getError(network, X, T, weights)}
         if validX is not None:
-            validerr = self.getError(network, validX, validT, 
+            errs['valid_error'] = self.getError(network, validX, validT, 
                     np.ones((validX.shape[0],)))
-            print "Final        : TrainErr = %4.3f, ValidErr = %4.3f" % \
-                    (trainerr, validerr)
-        else:
-            print "Final        : TrainErr = %4.3f" %(trainerr)
-
-        return network
+        return errs
 
     def getError(self, network, X, T, weights):
         '''
@@ -198,7 +244,7 @@ class NeuralNet(object):
         validerr = err / np.sum(weights)
         return validerr
 
-    def doBackprop(self, data, targets, network):
+    def doBackprop(self, data, targets, network, callbacks=None):
         '''
         Executes 1 iteration of backprop
 
@@ -206,8 +252,11 @@ class NeuralNet(object):
             array data:         the training data
             array targets:      the training targets
             list[obj] network:  the network
+            list callbacks:     objects that receive the cg_batch events
         This function is designed to be called by the train() method
         '''
+        import scipy.optimize
+        emitter = events.emitter(callbacks)
         no_layers = len(network)
         index = np.arange(self.n)
         np.random.shuffle(index)
@@ -218,39 +267,29 @@ class NeuralNet(object):
                 batchend = self.n
             else:
                 batchend = batch + self.batch_size
+            batch_start = time.time()
             # Select current batch
             tmpX = data[index[batch:batchend],:]
             tmpT = targets[index[batch:batchend],:]
             tmpW = self.weights[index[batch:batchend],:]
 
             # flatten out the weights and store them in v
-            v = []
-            for i in range(no_layers):
-                w = network[i].W.as_numpy_array()
-                b = network[i].hbias.as_numpy_array()
-                v.extend((w.reshape((w.shape[0]*w.shape[1],))).tolist())
-                v.extend((b.reshape((b.shape[0]*b.shape[1],))).tolist())
-            v = np.asarray(v)
+            v = self.flatten_weights(network)
 
             # Conjugate gradient minimiziation
             result = scipy.optimize.minimize(self.backprop_gradient, v, 
                     args=(network, tmpX, tmpT, tmpW),
                     method='CG', jac=True, options={'maxiter': self.cg_iter})
-            if (count%10 == 0):
-                print "batch %d of %d. success: %s" %(count+1, nbatches, 
-                     str(result.success))
-            count += 1         
             v = result.x
 
             # unflatten v and put new weights back
-            ind =0 
-            for i in range(no_layers):
-                h,w = network[i].W.shape
-                network[i].W = gp.garray((v[ind:(ind+h*w)]).reshape((h,w)))
-                ind += h*w
-                b = len(network[i].hbias)
-                network[i].hbias = gp.garray((v[ind:(ind+b)]).reshape((b,1)))
-                ind += b
+            self.unflatten_weights(v, network)
+            seconds = time.time() - batch_start
+            emitter.emit('cg_batch', network, batch=count, nbatches=nbatches,
+                    rows=batchend-batch, seconds=seconds, 
+                    rows_per_sec=(batchend-batch)/max(seconds, 1e-9),
+                    success=bool(result.success))
+            count += 1         
 
         # debugging help
         #print "=================="
@@ -290,23 +329,21 @@ class NeuralNet(object):
         numHiddenLayers = len(network)
 
         # put the v weights back into the network
-        ind =0 
-        for i in range(numHiddenLayers):
-            h,w = network[i].W.shape
-            network[i].W = gp.garray((v[ind:(ind+h*w)]).reshape((h,w)))
-            ind += h*w
-            b = network[i].hbias.shape[0]
-            network[i].hbias = gp.garray(v[ind:(ind+b)]).reshape((b,1))
-            ind += b
+        self.unflatten_weights(v, network)
 
         # Run data through the network, keeping activations of each layer
         acts = [X] # a list of numpy arrays
         hid = X
         for layer in network:
-            vis = gp.garray(hid)
+            if isinstance(hid, splitdata.SplitData):
+                vis = hid
+            else:
+                vis = transfers.to_device(hid, 'NeuralNet.backprop_gradient')
             hid = self.get_activation(layer, vis) 
             acts.append(hid)
-            gp.free_reuse_cache()
+            transfers.free_cache('NeuralNet.backprop_gradient')
+        # the weight gradient of the first layer needs the batch as one array
+        acts[0] = splitdata.asarray(acts[0])
 
         # store the gradients
         dW = []
@@ -323,12 +360,12 @@ class NeuralNet(object):
                     weights.T)
             Ix = (acts[-1] - targets)
         Ix *= np.tile(weights, (1, Ix.shape[1])).reshape((Ix.shape[0],Ix.shape[1]))
-        Ix = gp.garray(Ix)
+        Ix = transfers.to_device(Ix, 'NeuralNet.backprop_gradient')
 
         # Compute the gradients
         for i in range(numHiddenLayers-1,-1,-1):
             # augment activations with ones
-            acts[i] = gp.garray(acts[i])
+            acts[i] = transfers.to_device(acts[i], 'NeuralNet.backprop_gradient')
             acts[i] = gp.concatenate((acts[i], gp.ones((n,1))), axis=1)
 
             # compute delta in next layer
@@ -344,25 +381,94 @@ class NeuralNet(object):
                     Ix = gp.dot(Ix,gp.concatenate((network[i].W,network[i].hbias),
                         axis=1)) * acts[i] * (1.0 - acts[i])
                 elif network[i-1].hidtype == 'gaussian':
-                    Ix = gp.dot(Ix,gp.concatentate((network[i].W,network[i].hbias),
+                    Ix = gp.dot(Ix,gp.concatenate((network[i].W,network[i].hbias),
                         axis=1))
                 Ix = Ix[:,:-1]
-            gp.free_reuse_cache()
+            transfers.free_cache('NeuralNet.backprop_gradient')
         dW.reverse()
         db.reverse()
 
-        # Convert gradient information
+        # Convert gradient information. The gradient of a tied layer is 
+        # accumulated into the layer that holds its weights.
+        owners = self.weight_owners(network)
+        for i in range(numHiddenLayers):
+            if owners[i] != i:
+                dW[owners[i]] = dW[owners[i]] + dW[i].T
         grad = np.zeros_like(v)
         ind = 0
         for i in range(numHiddenLayers):
-            grad[ind:(ind+dW[i].size)] = \
-                 (dW[i].reshape((dW[i].shape[0]*dW[i].shape[1],1))).as_numpy_array()
-            ind += dW[i].size
-            grad[ind:(ind+db[i].size),0] = db[i].as_numpy_array()
+            if owners[i] == i:
+                grad[ind:(ind+dW[i].size)] = \
+                     transfers.to_host(dW[i].reshape((dW[i].shape[0]*dW[i].shape[1],1)),
+                             'NeuralNet.backprop_gradient')
+                ind += dW[i].size
+            grad[ind:(ind+db[i].size),0] = transfers.to_host(db[i],
+                    'NeuralNet.backprop_gradient')
             ind += db[i].size
         grad = grad.reshape((grad.shape[0],))
         return cost, grad  
 
+    def weight_owners(self, network):
+        '''
+        Finds which layer holds the weights of each layer in the network. A
+        TiedLayer uses the weights of the layer it is tied to when that layer is
+        in the network; otherwise (e.g. training only the top layer) it is
+        treated as owning them.
+
+        args:
+            list[obj] network:  the network
+        returns:
+            list[int] owners:   for each layer, the index of the layer in network
+                                whose weights it uses
+        '''
+        owners = range(len(network))
+        for i in range(len(network)):
+            if isinstance(network[i], TiedLayer):
+                for j in range(i):
+                    if network[j] is network[i].tied:
+                        owners[i] = j
+        return owners
+
+    def flatten_weights(self, network):
+        '''
+        Flattens the weights and biases of the network into a 1d vector for CG
+        optimization. Shared weights appear only once.
+
+        args:
+            list[obj] network:  the network
+        returns:
+            array v:            the 1d vector of weights
+        '''
+        owners = self.weight_owners(network)
+        v = []
+        for i in range(len(network)):
+            if owners[i] == i:
+                v.append(transfers.to_host(network[i].W, 'NeuralNet.flatten_weights').ravel())
+            v.append(transfers.to_host(network[i].hbias, 'NeuralNet.flatten_weights').ravel())
+        return np.concatenate(v)
+
+    def unflatten_weights(self, v, network):
+        '''
+        Puts the weights in the 1d vector v back into the network, the inverse
+        of flatten_weights.
+
+        args:
+            array v:            the 1d vector of weights
+            list[obj] network:  the network
+        '''
+        owners = self.weight_owners(network)
+        ind = 0
+        for i in range(len(network)):
+            if owners[i] == i:
+                h,w = network[i].W.shape
+                network[i].W = transfers.to_device((v[ind:(ind+h*w)]).reshape((h,w)),
+                        'NeuralNet.unflatten_weights')
+                ind += h*w
+            b = network[i].hbias.shape[0]
+            network[i].hbias = transfers.to_device((v[ind:(ind+b)]).reshape((b,1)),
+                    'NeuralNet.unflatten_weights')
+            ind += b
+
 class Layer(object):
     '''
     A hidden layer object
@@ -374,14 +480,44 @@ class Layer(object):
         string hidtype: the activation function "sigmoid" or "gaussian"
     '''
     def __init__(self, W, hbias, n_hidden, hidtype):
-        self.W = gp.garray(W)
+        self.W = transfers.to_device(W, 'Layer')
+        # convert 1d arrays to 2d
+        if len(hbias.shape) == 1:
+            hbias = hbias.reshape((hbias.shape[0],1))
+        self.hbias = transfers.to_device(hbias, 'Layer')
+        self.n_hidden = n_hidden
+        self.hidtype = hidtype
+
+class TiedLayer(object):
+    '''
+    A hidden layer whose weights are the transpose of another layer's, e.g. a
+    decoder layer of an autoencoder with tied weights. The layer owns only its
+    bias; reading or setting W goes through the weights of the tied layer, so
+    the weights are stored once.
+
+    args:
+        obj tied:       the layer whose weights are shared
+        array hbias:    the bias weights
+        int n_hidden:   the number of hidden units
+        string hidtype: the activation function "sigmoid" or "gaussian"
+    '''
+    def __init__(self, tied, hbias, n_hidden, hidtype):
+        self.tied = tied
         # convert 1d arrays to 2d
         if len(hbias.shape) == 1:
             hbias = hbias.reshape((hbias.shape[0],1))
-        self.hbias = gp.garray(hbias)
+        self.hbias = transfers.to_device(hbias, 'TiedLayer')
         self.n_hidden = n_hidden
         self.hidtype = hidtype
-   
+
+    def _get_W(self):
+        return self.tied.W.T
+
+    def _set_W(self, W):
+        self.tied.W = W.T
+
+    W = property(_get_W, _set_W)
+
 def demo_xor():
     '''Demonstration of backprop with classic XOR example
     '''
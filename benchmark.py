@@ -0,0 +1,275 @@
+import numpy as np
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+
+def synthetic_frame(rng, contour_x, contour_y, shape=(480, 640)):
+    '''
+    Makes an ultrasound-like frame: speckle noise, darker towards the bottom,
+    with a bright band just below the tongue contour and shadow under it.
+
+    args:
+        RandomState rng:        the random number generator
+        array contour_x:        the x coords of the contour points
+        array contour_y:        the y coords of the contour points
+        tuple shape:            (height, width) of the frame
+    returns:
+        array img:              a uint8 grayscale image
+    '''
+    height, width = shape
+    speckle = rng.rayleigh(0.25, shape)
+    depth = np.linspace(1., 0.4, height)[:, np.newaxis]
+    img = speckle * depth
+    rows = np.arange(height)[:, np.newaxis]
+    cols = np.arange(width)
+    surface = np.interp(cols, contour_x, contour_y, left=np.nan, right=np.nan)
+    d = rows - surface[np.newaxis, :]
+    inside = ~np.isnan(surface)[np.newaxis, :]
+    band = np.where(inside, np.exp(-np.square(np.nan_to_num(d - 2.)/3.)), 0.)
+    shadow = np.where(inside & (np.nan_to_num(d) > 6), 0.5, 1.)
+    img = (img + 0.8*band) * shadow
+    return np.clip(img*255, 0, 255).astype(np.uint8)
+
+def synthetic_contour(rng, n_points=32, roi=(140, 320, 250, 580)):
+    '''
+    Makes a tongue-like trace of n_points inside the roi, as in TongueContours.csv
+    returns arrays x, y of ints
+    '''
+    top, bottom, left, right = roi
+    x0 = rng.uniform(left + 10, left + 60)
+    x1 = rng.uniform(right - 60, right - 10)
+    x = np.linspace(x0, x1, n_points)
+    height = rng.uniform(30, 70)
+    mid = rng.uniform(top + 70, top + 110)
+    t = (x - x0)/(x1 - x0)
+    y = mid + height*np.square(2*t - 1) - height/2.
+    return np.round(x).astype(np.int), np.round(y).astype(np.int)
+
+def make_synthetic_subject(data_dir, n_frames, shape=(480, 640), roi=(140, 320, 250, 580),
+        seed=0):
+    '''
+    Writes a synthetic subject directory that Loader can read: JPG/ with
+    ultrasound-like frames, TongueContours.csv with their traces and
+    ROI_config.txt.
+
+    args:
+        string data_dir:    the directory to write
+        int n_frames:       the number of frames
+        tuple shape:        (height, width) of the frames
+        tuple roi:          (top, bottom, left, right) written to ROI_config.txt
+        int seed:           seed for the random number generator
+    '''
+    import cv
+    rng = np.random.RandomState(seed)
+    jpg_dir = os.path.join(data_dir, 'JPG')
+    if not os.path.isdir(jpg_dir):
+        os.makedirs(jpg_dir)
+    f = open(os.path.join(data_dir, 'TongueContours.csv'), 'w')
+    header = ['Filename']
+    for j in range(32):
+        header.extend(['X%d' % (j+1), 'Y%d' % (j+1)])
+    f.write('\t'.join(header) + '\n')
+    for i in range(n_frames):
+        x, y = synthetic_contour(rng, 32, roi)
+        name = 'frame%06d.jpg' % i
+        img = synthetic_frame(rng, x, y, shape)
+        cv.SaveImage(os.path.join(jpg_dir, name), cv.fromarray(img))
+        cells = [name]
+        for j in range(32):
+            cells.extend([str(x[j]), str(y[j])])
+        f.write('\t'.join(cells) + '\n')
+    f.close()
+    f = open(os.path.join(data_dir, 'ROI_config.txt'), 'w')
+    f.write('ROI\n')
+    for key, value in zip(['top', 'bottom', 'left', 'right'], roi):
+        f.write('%s\t%d\n' % (key, value))
+    f.close()
+
+def synthetic_data(n_rows, n_cols, seed=0):
+    '''
+    Makes a float32 data set shaped like XC, with values in [0, 1]
+    '''
+    rng = np.random.RandomState(seed)
+    return rng.uniform(0, 1, (n_rows, n_cols)).astype(np.float32)
+
+def best_time(func, repeat=3):
+    '''
+    Runs func repeat times and returns the fastest wall time in seconds
+    '''
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+class Benchmark(object):
+    '''
+    Times the hot paths of the training and data preparation code on synthetic
+    data, and compares the timings against a saved baseline.
+
+    args:
+        list[int] sizes:    the layer sizes to run
+        list[int] rows:     the numbers of data rows to run
+        int frames:         the number of frames in the synthetic subject
+        int repeat:         each timing is the best of this many runs
+    '''
+    def __init__(self, sizes=(256, 1024), rows=(1024, 4096), frames=200, repeat=3):
+        self.sizes = sizes
+        self.rows = rows
+        self.frames = frames
+        self.repeat = repeat
+        self.results = []
+
+    def record(self, name, seconds, n_rows, **params):
+        result = {'name': name, 'seconds': seconds, 'rows': n_rows,
+                'rows_per_sec': n_rows/max(seconds, 1e-9)}
+        result.update(params)
+        self.results.append(result)
+        print "%-40s %-28s %10.4f s %12.1f rows/s" % (name,
+                ' '.join(['%s=%s' % (k, params[k]) for k in sorted(params)]),
+                seconds, result['rows_per_sec'])
+
+    def run_deepnet(self):
+        import deepnet
+        for n in self.sizes:
+            # initialization doesn't depend on the data, so it is timed once per
+            # size, counting the rows of the weight matrix
+            t = best_time(lambda: deepnet.RBM(n, n, rng=0), self.repeat)
+            self.record('RBM.__init__', t, n, n_visible=n, n_hidden=n)
+            for n_rows in self.rows:
+                data = synthetic_data(n_rows, n)
+                rbm = deepnet.RBM(n, n)
+                t = best_time(lambda: rbm.train(data, 1, early_stop=False,
+                    callbacks=[]), self.repeat)
+                self.record('RBM.train epoch', t, n_rows, n_visible=n, n_hidden=n)
+
+                dnn = deepnet.DeepNet([n, n, n], ['sigmoid']*3)
+                t = best_time(lambda: dnn.get_activation(rbm, data), self.repeat)
+                self.record('DeepNet.get_activation', t, n_rows, n_visible=n, n_hidden=n)
+
+                dnn.network = [deepnet.Holder(rbm), deepnet.Holder(rbm)]
+                t = best_time(lambda: dnn.run_through_network(data), self.repeat)
+                self.record('DeepNet.run_through_network', t, n_rows, layers=2, size=n)
+
+    def run_backprop(self):
+        import backprop
+        for n in self.sizes:
+            for n_rows in self.rows:
+                data = synthetic_data(n_rows, n)
+                nn = backprop.NeuralNet(layer_sizes=[n, n, n],
+                        layer_types=['sigmoid']*3)
+                # the attributes NeuralNet.train sets up before backprop
+                nn.targetCost = 'linSquaredErr'
+                nn.n, nn.m = data.shape
+                nn.cg_iter = 3
+                nn.batch_size = 1024
+                nn.weights = np.ones((nn.n, 1))
+                v = nn.flatten_weights(nn.network)
+                batch = data[:nn.batch_size]
+                t = best_time(lambda: nn.backprop_gradient(v, nn.network, batch,
+                    batch, nn.weights[:batch.shape[0]]), self.repeat)
+                self.record('NeuralNet.backprop_gradient', t, batch.shape[0],
+                        layers=2, size=n)
+                t = best_time(lambda: nn.doBackprop(data, data, nn.network,
+                    callbacks=[]), self.repeat)
+                self.record('NeuralNet.doBackprop', t, n_rows, layers=2, size=n,
+                        cg_iter=nn.cg_iter)
+
+    def run_loader(self):
+        import loadData
+        data_dir = tempfile.mkdtemp()
+        try:
+            make_synthetic_subject(data_dir, self.frames)
+            l = loadData.Loader(data_dir)
+            l.loadContours()
+            l.cleanContours()
+            t = best_time(l.makeContourImages, self.repeat)
+            self.record('Loader.makeContourImages', t, self.frames)
+            t = best_time(lambda: self.combine(l), self.repeat)
+            self.record('Loader.combineUltrasoundAndContourImages', t, self.frames)
+        finally:
+            shutil.rmtree(data_dir)
+
+    def run_imports(self):
+        # each import is timed in a fresh interpreter, as a worker would see it
+        here = os.path.dirname(os.path.abspath(__file__))
+        for module in ('inference', 'loadData', 'deepnet', 'backprop', 'autoencoder'):
+            t = best_time(lambda: subprocess.check_call([sys.executable, '-c',
+                'import %s' % module], cwd=here), self.repeat)
+            self.record('import', t, 1, module=module)
+
+    def combine(self, l):
+        # reset what combineUltrasoundAndContourImages computes, so every run
+        # does the same work
+        l.continds = None
+        l.m = None
+        l.s = None
+        l.combineUltrasoundAndContourImages()
+
+    def run(self, parts=('imports', 'loader', 'deepnet', 'backprop')):
+        for part in parts:
+            getattr(self, 'run_' + part)()
+        return self.results
+
+    def save(self, filename):
+        '''
+        Saves the results as a JSON baseline
+        '''
+        f = open(filename, 'w')
+        json.dump({'machine': platform.node(), 'platform': platform.platform(),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': self.results},
+            f, indent=1, sort_keys=True)
+        f.close()
+
+    def compare(self, filename, tolerance=1.2):
+        '''
+        Compares the results with a saved baseline and prints the timings that
+        are slower than the baseline by more than the tolerance factor.
+
+        returns:
+            list[tuple] regressions: (name, params, baseline secs, secs)
+        '''
+        baseline = json.load(open(filename, 'r'))['results']
+        def key(r):
+            return tuple(sorted([(k, r[k]) for k in r
+                if k not in ('seconds', 'rows_per_sec')]))
+        old = dict([(key(r), r['seconds']) for r in baseline])
+        regressions = []
+        for r in self.results:
+            k = key(r)
+            if k in old and r['seconds'] > old[k]*tolerance:
+                regressions.append((r['name'], k, old[k], r['seconds']))
+                print "REGRESSION %s: %.4f s -> %.4f s" % (r['name'], old[k],
+                        r['seconds'])
+        if len(regressions) == 0:
+            print "no regressions against %s" % filename
+        return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 1024])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1024, 4096])
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--parts', nargs='+',
+            default=['imports', 'loader', 'deepnet', 'backprop'])
+    parser.add_argument('--save', default=None, help='write the results to this baseline')
+    parser.add_argument('--baseline', default=None, help='compare against this baseline')
+    parser.add_argument('--tolerance', type=float, default=1.2)
+    args = parser.parse_args()
+    b = Benchmark(args.sizes, args.rows, args.frames, args.repeat)
+    b.run(args.parts)
+    if args.save is not None:
+        b.save(args.save)
+    if args.baseline is not None:
+        if len(b.compare(args.baseline, args.tolerance)) > 0:
+            sys.exit(1)
@@ -0,0 +1,184 @@
+import numpy as np
+
+def contour_blocks(output, loader):
+    '''
+    Takes the contour block out of network outputs (rows laid out like XC) and
+    undoes the normalization, giving the max-normalized contour values that
+    combineUltrasoundAndContourImages made.
+
+    args:
+        array output:   the network output, one row per frame
+        obj loader:     the Loader the network was trained with
+    returns:
+        array blocks:   the contour blocks, shape (frames, len(continds))
+    '''
+    npix = loader.height*loader.width
+    blocks = np.asarray(output)[:, npix:]
+    if not getattr(loader, 'sigmoid', False):
+        blocks = blocks*loader.s[npix:] + loader.m[npix:]
+    return blocks
+
+def contour_grid(blocks, continds, height, width):
+    '''
+    Scatters contour blocks back onto the (height, width) grid, zero outside
+    continds
+
+    returns:
+        array grid:     shape (frames, height, width)
+    '''
+    grid = np.zeros((blocks.shape[0], height*width), dtype=blocks.dtype)
+    grid[:, continds] = blocks
+    return grid.reshape((blocks.shape[0], height, width))
+
+def ridge_rows(grid, threshold=0.01):
+    '''
+    Finds the row of the contour ridge in every column of every frame. The peak
+    is refined to sub-pixel accuracy by fitting a parabola to the log of the
+    peak and its two neighbours, which is exact for the gaussian ridges made
+    by makeContourImages.
+
+    args:
+        array grid:         contour images, shape (frames, height, width)
+        float threshold:    columns whose peak is below this have no contour
+    returns:
+        array rows:         shape (frames, width), nan where there is no contour
+    '''
+    n, h, w = grid.shape
+    I = np.arange(n)[:, np.newaxis]
+    J = np.arange(w)[np.newaxis, :]
+    k = np.argmax(grid, axis=1)
+    peak = grid[I, k, J]
+    lo = np.log(np.maximum(grid[I, np.maximum(k-1, 0), J], 1e-6))
+    mid = np.log(np.maximum(peak, 1e-6))
+    hi = np.log(np.maximum(grid[I, np.minimum(k+1, h-1), J], 1e-6))
+    denom = lo - 2*mid + hi
+    interior = (k > 0) & (k < h-1) & (denom < 0)
+    offset = np.zeros(k.shape)
+    offset[interior] = 0.5*(lo - hi)[interior]/denom[interior]
+    rows = k + np.clip(offset, -0.5, 0.5)
+    rows[peak < threshold] = np.nan
+    return rows
+
+def grid_to_image(rows, loader):
+    '''
+    Maps ridge rows on the contour grid back to original image coordinates.
+    The contour grid is the contour image of makeContourImages, which covers
+    the contour extents (minx..maxx, miny..maxy), resized to (height, width).
+
+    args:
+        array rows:     ridge rows from ridge_rows, shape (frames, width)
+        obj loader:     the Loader the contour blocks came from
+    returns:
+        array x:        the image x coordinate of each grid column, (width,)
+        array y:        the image y coordinates, shape (frames, width)
+    '''
+    interprows = loader.maxy - loader.miny + 1
+    interpcols = loader.maxx - loader.minx + 1
+    # contour image row k is at y = miny+k-1, see WorkThread
+    y = loader.miny - 1 + (rows + 0.5)*interprows/float(loader.height) - 0.5
+    x = loader.minx + (np.arange(rows.shape[1]) + 0.5)*interpcols/float(loader.width) - 0.5
+    return x, y
+
+def resample(x, y, n_points=32):
+    '''
+    Resamples traces to n_points evenly spaced along x between the first and
+    last column with a contour. Gaps inside a trace are bridged linearly.
+
+    args:
+        array x:        the x coordinate of each column, shape (width,)
+        array y:        y coordinates, shape (frames, width), nan for no contour
+        int n_points:   the number of points in each trace
+    returns:
+        array px, py:   shape (frames, n_points), 0 for frames with fewer than
+                        two columns of contour, as in TongueContours.csv
+    '''
+    n, w = y.shape
+    valid = ~np.isnan(y)
+    cols = np.arange(w)
+    # the nearest valid column at or before / at or after each column
+    prev = np.maximum.accumulate(np.where(valid, cols, -1), axis=1)
+    nxt = np.minimum.accumulate(np.where(valid, cols, w)[:, ::-1], axis=1)[:, ::-1]
+    first = nxt[:, 0]
+    last = prev[:, -1]
+    ok = (first < last)
+    first[~ok] = 0
+    last[~ok] = 0
+
+    t = first[:, np.newaxis] + \
+            (last - first)[:, np.newaxis]*np.linspace(0., 1., n_points)[np.newaxis, :]
+    I = np.arange(n)[:, np.newaxis]
+    p = prev[I, np.floor(t).astype(np.int)]
+    q = nxt[I, np.ceil(t).astype(np.int)]
+    p = np.clip(p, 0, w-1)
+    q = np.clip(q, 0, w-1)
+    yfilled = np.where(valid, y, 0.)
+    frac = np.where(q > p, (t - p)/np.maximum(q - p, 1), 0.)
+    py = yfilled[I, p] + frac*(yfilled[I, q] - yfilled[I, p])
+    px = np.interp(t, cols, x)
+    px[~ok] = 0.
+    py[~ok] = 0.
+    return px, py
+
+def extract_contours(output, loader, n_points=32, threshold=0.01):
+    '''
+    Turns network outputs for a batch of frames into contour traces in
+    original image coordinates, with the same number of points as the traces
+    in TongueContours.csv.
+
+    args:
+        array output:       the network output, one row per frame
+        obj loader:         the Loader the network was trained with; needs
+                            height, width, continds, m, s and the contour
+                            extents minx, maxx, miny, maxy
+        int n_points:       the number of points in each trace
+        float threshold:    the smallest ridge value counted as contour
+    returns:
+        array x, y:         the trace coordinates, shape (frames, n_points)
+    '''
+    blocks = contour_blocks(output, loader)
+    grid = contour_grid(blocks, loader.continds, loader.height, loader.width)
+    rows = ridge_rows(grid, threshold)
+    x, y = grid_to_image(rows, loader)
+    return resample(x, y, n_points)
+
+def mean_sum_of_distances(x, y, truex, truey):
+    '''
+    Compares traces with hand traces using the mean sum of distances: the
+    distance from each point to the closest point of the other trace,
+    averaged over the points of both traces. Points with coordinates <= 0 are
+    treated as empty, like cleanContours does.
+
+    args:
+        array x, y:         the traces, shape (frames, points)
+        array truex, truey: the hand traces, shape (frames, points)
+    returns:
+        array msd:          the distance for each frame, nan if either trace
+                            is empty
+    '''
+    a = (x > 0) & (y > 0)
+    b = (truex > 0) & (truey > 0)
+    d = np.sqrt(np.square(x[:, :, np.newaxis] - truex[:, np.newaxis, :]) +
+            np.square(y[:, :, np.newaxis] - truey[:, np.newaxis, :]))
+    d[~(a[:, :, np.newaxis] & b[:, np.newaxis, :])] = np.inf
+    da = np.where(a, np.min(d, axis=2), 0.)
+    db = np.where(b, np.min(d, axis=1), 0.)
+    count = np.sum(a, axis=1) + np.sum(b, axis=1)
+    msd = (np.sum(da, axis=1) + np.sum(db, axis=1))/np.maximum(count, 1)
+    msd[(np.sum(a, axis=1) == 0) | (np.sum(b, axis=1) == 0)] = np.nan
+    return msd
+
+def write_contours(filename, names, x, y):
+    '''
+    Writes traces in the TongueContours.csv format read by Loader.loadContours
+    '''
+    f = open(filename, 'w')
+    header = ['Filename']
+    for j in range(x.shape[1]):
+        header.extend(['X%d' % (j+1), 'Y%d' % (j+1)])
+    f.write('\t'.join(header) + '\n')
+    for i in range(len(names)):
+        cells = [str(names[i])]
+        for j in range(x.shape[1]):
+            cells.extend(['%d' % np.round(x[i,j]), '%d' % np.round(y[i,j])])
+        f.write('\t'.join(cells) + '\n')
+    f.close()
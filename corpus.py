@@ -0,0 +1,331 @@
+import numpy as np
+import os
+import multiprocessing
+import time
+import traceback
+import Queue
+import loadData
+
+MANIFEST = 'corpus.npz'
+
+class IngestWorker(multiprocessing.Process):
+    '''
+    Takes jobs from WorkQueue and puts a dict with the subject number, the
+    results and the traceback if the job failed on ResultsQueue. A job is
+    ('scan', subject, data_dir, roi, shape, extents), which finds the contour
+    extents and mask of a subject, or ('ingest', subject, data_dir, roi,
+    shape, extents, continds, filename, max_images, dtype), which formats a
+    subject and saves it as a shard. The subject being worked on is kept in
+    current (-1 when idle), so the parent can tell which subject was lost if
+    the worker dies.
+    '''
+    def __init__(self, WorkQueue, ResultsQueue):
+        super(IngestWorker, self).__init__()
+        self.WorkQueue = WorkQueue
+        self.ResultsQueue = ResultsQueue
+        self.current = multiprocessing.Value('i', -1, lock=False)
+
+    def run(self):
+        flag = 'ok'
+        while (flag != 'stop'):
+            args = self.WorkQueue.get()
+            if args == None:
+                flag = 'stop'
+            else:
+                result = {'job': args[0], 'subject': args[1], 'traceback': None}
+                self.current.value = args[1]
+                start = time.time()
+                try:
+                    if args[0] == 'scan':
+                        result.update(scan_subject(*args[2:]))
+                    else:
+                        result.update(ingest_subject(*args[2:]))
+                except Exception:
+                    result['traceback'] = traceback.format_exc()
+                result['time'] = time.time() - start
+                self.ResultsQueue.put(result)
+                self.current.value = -1
+
+def scan_subject(data_dir, roi, shape, extents):
+    '''
+    returns {'extents': the extents of the subject's traces, 'mask': its
+    contour pixels on the grid of shape over extents, 'roi'}, from one
+    streaming pass over its TongueContours.csv
+    '''
+    l = loadData.Loader(data_dir, roi=roi, shape=shape, extents=extents)
+    l.scanContours()
+    return {'extents': l.trace_extents, 'mask': l.contmask, 'roi': l.getROI()}
+
+def ingest_subject(data_dir, roi, shape, extents, continds, filename, max_images,
+        dtype):
+    '''
+    Formats one subject with the corpus geometry and saves the unnormalized
+    rows as filename.npy and their statistics as filename_stats.npz
+
+    returns:
+        dict: rows, and total, sqtotal for the normalization
+    '''
+    l = loadData.Loader(data_dir, roi=roi, max_images=max_images, num_threads=1,
+            continds=continds, dtype=dtype, shape=shape, extents=extents)
+    l.loadData(sigmoid_1st_layer=True)
+    if isinstance(l.XC, loadData.ByteRows):
+        np.save(filename + '.npy', l.XC.raw)
+    else:
+        np.save(filename + '.npy', l.XC)
+    n = l.XC.shape[0]
+    np.savez(filename + '_stats.npz', total=l.total, sqtotal=l.sqtotal, n=n,
+            files=np.asarray(l.contfiles))
+    return {'rows': n, 'total': l.total, 'sqtotal': l.sqtotal}
+
+def run_jobs(jobs, num_workers):
+    '''
+    Runs jobs on num_workers IngestWorkers, returns the results in job order.
+    Raises RuntimeError with the tracebacks if any job failed, or naming the
+    subject if a worker process dies, e.g. killed for running out of memory.
+    '''
+    WorkQueue_ = multiprocessing.Queue()
+    ResultsQueue_ = multiprocessing.Queue()
+    workers = []
+    for i in range(min(num_workers, len(jobs))):
+        worker = IngestWorker(WorkQueue_, ResultsQueue_)
+        worker.start()
+        workers.append(worker)
+    for job in jobs:
+        WorkQueue_.put(job)
+    for worker in workers:
+        WorkQueue_.put(None)
+
+    results = []
+    failed = []
+    while len(results) < len(jobs):
+        try:
+            # poll, so a worker that is killed doesn't leave us waiting forever
+            result = ResultsQueue_.get(timeout=1.)
+        except Queue.Empty:
+            for worker in workers:
+                if (not worker.is_alive()) and (worker.exitcode != 0):
+                    for other in workers:
+                        other.terminate()
+                    subject = worker.current.value
+                    if subject < 0:
+                        raise RuntimeError("an ingest worker died with exit code %d"
+                                % worker.exitcode)
+                    raise RuntimeError("subject %d (%s) failed: its worker died "
+                            "with exit code %d" % (subject+1, jobs[subject][2],
+                                worker.exitcode))
+            continue
+        if result['traceback'] is not None:
+            failed.append("subject %d (%s) failed:\n%s" % (result['subject']+1,
+                jobs[result['subject']][2], result['traceback']))
+        elif result['job'] == 'ingest':
+            print "subject %d of %d: %d rows (%.1f s)" % (result['subject']+1,
+                    len(jobs), result['rows'], result['time'])
+        results.append(result)
+    for worker in workers:
+        worker.join()
+    if len(failed) > 0:
+        raise RuntimeError('\n'.join(failed))
+    return sorted(results, key = lambda r: r['subject'])
+
+def merge_stats(totals, sqtotals, ns):
+    '''
+    Merges per-shard column sums into the mean and sd of all the rows, the
+    way Loader computes them for one subject
+
+    returns:
+        tuple (m, s)
+    '''
+    n = float(np.sum(ns))
+    m = np.sum(totals, axis=0)/n
+    s = np.sqrt(np.maximum(np.sum(sqtotals, axis=0)/n - m**2, 0.))
+    s[s<0.001] = 1.
+    return m, s
+
+def build_corpus(data_dirs, out_dir, roi=None, shape=None, max_images=None,
+        num_workers=None, dtype=np.float32):
+    '''
+    Formats many subjects in parallel processes, each into its own shard on
+    disk, and returns a Corpus over all of them. Every subject is formatted
+    with the same image size, and its contour images are drawn over the same
+    image region, the extents of the traces of all the subjects, so a
+    contour pixel is the same image position in every shard. The contour
+    pixels kept are the union of those of every subject. The extents and the
+    pixels come from streaming passes over each TongueContours.csv before
+    any images are loaded.
+
+        c = corpus.build_corpus(['subj1', 'subj2', 'subj3'], 'corpus')
+        X = c.getRows()
+
+    args:
+        list data_dirs:     the subject directories, as for Loader
+        string out_dir:     where the shards and the manifest are saved
+        list roi:           the roi of every subject, as for Loader; default
+                            each subject's ROI_config.txt. Can also be a
+                            list with one roi per subject
+        tuple shape:        (height, width) of the data images, default the
+                            size Loader would use for the first subject
+        int max_images:     sample at most this many images per subject
+        int num_workers:    number of processes, default min(subjects, cpus)
+        dtype dtype:        storage type of the shards, float32 or uint8
+    returns:
+        Corpus corpus:      the lazy view of the shards
+    '''
+    if num_workers is None:
+        num_workers = min(len(data_dirs), multiprocessing.cpu_count())
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    if (roi is None) or (roi == 'auto') or np.isscalar(roi[0]):
+        rois = [roi]*len(data_dirs)
+    else:
+        rois = list(roi)
+    if shape is None:
+        first = loadData.Loader(data_dirs[0], roi=rois[0])
+        first.scanContours()
+        shape = first.heatmap.shape
+    shape = (int(shape[0]), int(shape[1]))
+
+    print "Scanning contours..."
+    jobs = [('scan', i, data_dirs[i], rois[i], shape, None)
+            for i in range(len(data_dirs))]
+    results = run_jobs(jobs, num_workers)
+    # an 'auto' roi is fixed once, so the shards don't depend on the scan
+    rois = [tuple(result['roi']) for result in results]
+    found = np.asarray([result['extents'] for result in results])
+    extents = (int(np.min(found[:, 0])), int(np.min(found[:, 1])),
+            int(np.max(found[:, 2])), int(np.max(found[:, 3])))
+    # the masks are found again on the grid over the corpus extents
+    jobs = [('scan', i, data_dirs[i], rois[i], shape, extents)
+            for i in range(len(data_dirs))]
+    results = run_jobs(jobs, num_workers)
+    mask = np.zeros(shape, dtype=np.bool)
+    for result in results:
+        mask |= result['mask']
+    continds = np.arange(shape[0]*shape[1])[mask.reshape((shape[0]*shape[1],))]
+
+    print "Ingesting %d subjects..." % len(data_dirs)
+    shards = ['subject%03d' % i for i in range(len(data_dirs))]
+    jobs = [('ingest', i, data_dirs[i], rois[i], shape, extents, continds,
+        os.path.join(out_dir, shards[i]), max_images, dtype)
+        for i in range(len(data_dirs))]
+    results = run_jobs(jobs, num_workers)
+    np.savez(os.path.join(out_dir, MANIFEST), shards=np.asarray(shards),
+            data_dirs=np.asarray(data_dirs), rois=np.asarray(rois),
+            height=shape[0], width=shape[1], extents=np.asarray(extents),
+            continds=continds,
+            rows=np.asarray([r['rows'] for r in results]),
+            total=np.asarray([r['total'] for r in results]),
+            sqtotal=np.asarray([r['sqtotal'] for r in results]),
+            dtype=np.dtype(dtype).str)
+    return Corpus(out_dir)
+
+class Corpus(object):
+    '''
+    A read-only view of the subjects saved by build_corpus. The shards are
+    memory mapped, and rows are read from disk only when they are indexed, so
+    the corpus never has to fit in memory. Rows come out as float32,
+    normalized with the mean and sd of the whole corpus unless sigmoid is
+    True. Supports shape, size, len, and row indexing with ints, slices or
+    index arrays, like crossval.FoldView.
+
+    args:
+        string out_dir:     the directory given to build_corpus
+        bool sigmoid:       don't normalize, as for a sigmoid first layer
+        list subjects:      only use these subjects, default all of them.
+                            The statistics are still those of the whole corpus
+
+    variables:
+        int height, width:  the size of the data images
+        int minx, miny, maxx, maxy: the image region of the contour images, so
+                            a Corpus can stand in for the Loader in
+                            contours.extract_contours
+        array continds:     the contour pixels kept in every subject
+        array m, s:         the mean and sd of the whole corpus
+        array starts:       the first row of each subject
+    '''
+    def __init__(self, out_dir, sigmoid=False, subjects=None):
+        manifest = np.load(os.path.join(out_dir, MANIFEST))
+        self.out_dir = out_dir
+        self.sigmoid = sigmoid
+        self.height = int(manifest['height'])
+        self.width = int(manifest['width'])
+        self.minx, self.miny, self.maxx, self.maxy = [int(e) for e in manifest['extents']]
+        self.continds = manifest['continds']
+        self.data_dirs = list(manifest['data_dirs'])
+        self.m, self.s = merge_stats(manifest['total'], manifest['sqtotal'],
+                manifest['rows'])
+        if subjects is None:
+            subjects = range(len(manifest['shards']))
+        self.subjects = list(subjects)
+        self.shards = [np.load(os.path.join(out_dir, manifest['shards'][i] + '.npy'),
+            mmap_mode='r') for i in self.subjects]
+        rows = np.asarray([shard.shape[0] for shard in self.shards], dtype=np.int)
+        self.starts = np.concatenate([[0], np.cumsum(rows)])
+        self.shape = (int(self.starts[-1]), self.height*self.width + len(self.continds))
+        self.size = self.shape[0]*self.shape[1]
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def subject_rows(self, subject):
+        '''
+        returns the indices of the rows of a subject, e.g. to hold one subject
+        out for validation
+        '''
+        i = self.subjects.index(subject)
+        return np.arange(self.starts[i], self.starts[i+1])
+
+    def getRows(self, inds=None):
+        ''' Returns rows of the corpus ready for training.
+
+            args:
+                array inds: the rows to return, default all rows
+            returns:
+                array X:    the selected rows, float32
+        '''
+        if inds is None:
+            inds = np.arange(self.shape[0])
+        inds = np.asarray(inds)
+        X = np.zeros((len(inds), self.shape[1]), dtype=np.float32)
+        shard = np.searchsorted(self.starts, inds, side='right') - 1
+        for i in np.unique(shard):
+            sel = np.nonzero(shard == i)[0]
+            local = inds[sel] - self.starts[i]
+            if np.all(np.diff(local) == 1):
+                X[sel] = self.shards[i][local[0]:local[-1]+1]
+            else:
+                X[sel] = self.shards[i][local]
+        if self.shards[0].dtype == np.uint8:
+            X /= 255.
+        if self.sigmoid == False:
+            X -= self.m
+            X /= self.s
+        return X
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows = key[0]
+            rest = key[1:]
+        else:
+            rows = key
+            rest = ()
+        if isinstance(rows, slice):
+            out = self.getRows(np.arange(*rows.indices(self.shape[0])))
+        elif np.isscalar(rows):
+            if rows < 0:
+                rows += self.shape[0]
+            out = self.getRows([rows])[0]
+        else:
+            out = self.getRows(rows)
+        if len(rest) > 0:
+            if np.isscalar(rows):
+                out = out[rest]
+            else:
+                out = out[(slice(None),) + rest]
+        return out
+
+    def __array__(self, dtype=None):
+        out = self.getRows()
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
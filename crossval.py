@@ -0,0 +1,259 @@
+import numpy as np
+import multiprocessing
+import ctypes
+import time
+import traceback
+import Queue
+
+def shared_array(shape, dtype=np.float32):
+    '''
+    Allocates a numpy array in shared memory. Worker processes started by
+    cross_validate read an array made this way directly instead of getting a
+    copy.
+
+    args:
+        tuple shape:  the shape of the array
+        dtype dtype:  the array type, default float32
+    returns:
+        array arr:    a zeroed numpy array backed by shared memory
+    '''
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = multiprocessing.RawArray('c', max(nbytes, 1))
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def shared_buffer(arr):
+    '''
+    Finds the shared memory that an array made by shared_array, or a
+    contiguous view of one, lives in.
+
+    returns:
+        tuple (raw, offset): the shared memory and the byte offset of arr in
+                            it, or None if arr is not in shared memory
+    '''
+    if not arr.flags['C_CONTIGUOUS']:
+        return None
+    base = arr
+    while base is not None:
+        if isinstance(base, ctypes.Array):
+            offset = arr.__array_interface__['data'][0] - ctypes.addressof(base)
+            return base, offset
+        base = getattr(base, 'base', None)
+    return None
+
+def from_shared(raw, offset, shape, dtype):
+    '''
+    Makes a numpy array onto shared memory found by shared_buffer, e.g. in a
+    worker process
+    '''
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape)),
+            offset=offset).reshape(shape)
+
+class FoldView(object):
+    '''
+    A read-only view of the rows of a data set selected by an index array. Rows
+    are only gathered when they are sliced out, so a fold is never copied into
+    its own matrix. Supports the operations used by RBM.train, DeepNet.train
+    and NeuralNet.train: shape, size, and row indexing with slices or arrays.
+
+    args:
+        array data: the full data set
+        array inds: the rows that make up the view
+    '''
+    def __init__(self, data, inds):
+        self.data = data
+        self.inds = np.asarray(inds)
+        self.shape = (len(self.inds),) + data.shape[1:]
+        self.size = int(np.prod(self.shape))
+        self.dtype = data.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows = key[0]
+            rest = key[1:]
+        else:
+            rows = key
+            rest = ()
+        out = self.data[self.inds[rows]]
+        if len(rest) > 0:
+            if np.isscalar(self.inds[rows]):
+                out = out[rest]
+            else:
+                out = out[(slice(None),) + rest]
+        return out
+
+    def __array__(self, dtype=None):
+        out = self.data[self.inds]
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
+
+class FoldWorker(multiprocessing.Process):
+    '''
+    Trains and evaluates folds taken from WorkQueue, putting a dict with the
+    fold number, error and wall time on ResultsQueue. The fold being trained
+    is kept in current (-1 when idle), so the parent can tell which fold was
+    lost if the worker dies.
+    '''
+    def __init__(self, WorkQueue, ResultsQueue, raw, offset, shape, dtype, factory,
+            wrap=None):
+        super(FoldWorker, self).__init__()
+        self.WorkQueue = WorkQueue
+        self.ResultsQueue = ResultsQueue
+        self.raw = raw
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+        self.factory = factory
+        self.wrap = wrap
+        self.current = multiprocessing.Value('i', -1, lock=False)
+
+    def run(self):
+        data = from_shared(self.raw, self.offset, self.shape, self.dtype)
+        if self.wrap is not None:
+            data = self.wrap(data)
+        flag = 'ok'
+        while (flag != 'stop'):
+            args = self.WorkQueue.get()
+            if args == None:
+                flag = 'stop'
+            else:
+                fold = args[0]
+                self.current.value = fold
+                train = FoldView(data, args[1])
+                valid = FoldView(data, args[2])
+                result = {'fold': fold, 'error': np.nan, 'traceback': None}
+                start = time.time()
+                try:
+                    out = self.factory(train, valid)
+                    if isinstance(out, dict):
+                        result.update(out)
+                    else:
+                        result['error'] = out
+                except Exception:
+                    result['traceback'] = traceback.format_exc()
+                result['time'] = time.time() - start
+                self.ResultsQueue.put(result)
+                self.current.value = -1
+
+def cross_validate(data, traininds, validinds, factory, num_workers=None):
+    '''
+    Runs all the folds of a cross validation concurrently, e.g. the folds
+    made by Loader.getTVInds:
+
+        l.getTVInds(5)
+        results = cross_validate(l.XC, l.traininds, l.validinds, factory)
+
+    Every worker reads the same shared-memory copy of data through FoldViews,
+    so no fold matrices are built. If data was not made with shared_array it
+    is copied into shared memory once. A loadData.ByteRows is shared as its
+    raw bytes and normalized in the workers as rows are read.
+
+    args:
+        array data:         the full data set
+        list traininds:     the training indices for each fold
+        list validinds:     the validation indices for each fold
+        callable factory:   called as factory(train, valid) with two FoldViews,
+                            returns the validation error, or a dict with an
+                            'error' entry and any other results to keep
+        int num_workers:    number of processes, default min(folds, cpus)
+    returns:
+        list[dict] results: for each fold, the fold number, error, wall time,
+                            and the traceback if the fold failed
+    Raises RuntimeError if a worker process dies, e.g. killed for running out
+    of memory.
+    '''
+    nFolds = len(traininds)
+    if num_workers is None:
+        num_workers = min(nFolds, multiprocessing.cpu_count())
+    wrap = None
+    if hasattr(data, 'rewrap'):
+        wrap = data.rewrap
+        data = data.raw
+    shared = shared_buffer(data)
+    if shared is None:
+        copy = shared_array(data.shape, data.dtype)
+        copy[:] = data
+        shared = shared_buffer(copy)
+    raw, offset = shared
+
+    WorkQueue_ = multiprocessing.Queue()
+    ResultsQueue_ = multiprocessing.Queue()
+    workers = []
+    for i in range(num_workers):
+        worker = FoldWorker(WorkQueue_, ResultsQueue_, raw, offset, data.shape,
+                data.dtype, factory, wrap)
+        worker.start()
+        workers.append(worker)
+
+    for k in range(nFolds):
+        WorkQueue_.put((k, np.asarray(traininds[k]), np.asarray(validinds[k])))
+    for i in range(num_workers):
+        WorkQueue_.put(None)
+
+    results = []
+    while len(results) < nFolds:
+        try:
+            # poll, so a worker that is killed doesn't leave us waiting forever
+            result = ResultsQueue_.get(timeout=1.)
+        except Queue.Empty:
+            for worker in workers:
+                if (not worker.is_alive()) and (worker.exitcode != 0):
+                    for other in workers:
+                        other.terminate()
+                    fold = worker.current.value
+                    if fold < 0:
+                        raise RuntimeError("a fold worker died with exit code %d"
+                                % worker.exitcode)
+                    raise RuntimeError("fold %d failed: its worker died with exit "
+                            "code %d" % (fold+1, worker.exitcode))
+            continue
+        if result['traceback'] is not None:
+            print "fold %d failed:\n%s" % (result['fold']+1, result['traceback'])
+        else:
+            print "fold %d of %d: error = %4.3f (%.1f s)" % (result['fold']+1,
+                    nFolds, result['error'], result['time'])
+        results.append(result)
+    for worker in workers:
+        worker.join()
+    return sorted(results, key = lambda r: r['fold'])
+
+class AutoencoderFactory(object):
+    '''
+    Trains one fold the way autoencoder.demo_autoencoder does: a DeepNet is
+    pretrained on the training rows, unrolled into an autoencoder and
+    fine-tuned with backprop. The validation error is the reconstruction
+    error of the fine-tuned network on the validation rows.
+
+    args:
+        list[int] layer_sizes:  the DeepNet layer sizes
+        list[str] layer_types:  the DeepNet layer types
+        list[int] epochs:       pretraining epochs for each RBM
+        float eta:              the pretraining learning rate
+        int max_iter:           the number of backprop iterations
+    '''
+    def __init__(self, layer_sizes, layer_types, epochs, eta, max_iter=30):
+        self.layer_sizes = layer_sizes
+        self.layer_types = layer_types
+        self.epochs = epochs
+        self.eta = eta
+        self.max_iter = max_iter
+
+    def __call__(self, train, valid):
+        # imported here so each worker sets up its own gnumpy state
+        import deepnet
+        import backprop
+        import autoencoder
+        start = time.time()
+        dnn = deepnet.DeepNet(self.layer_sizes, self.layer_types)
+        dnn.train(train, self.epochs, self.eta)
+        pretrain_time = time.time() - start
+        mlp = backprop.NeuralNet(network=autoencoder.unroll_network(dnn.network))
+        net = mlp.train(mlp.network, train, train, max_iter=self.max_iter,
+                validErrFunc='reconstruction', targetCost='linSquaredErr')
+        err = mlp.getError(net, valid, valid, np.ones((valid.shape[0],)))
+        return {'error': err, 'pretrain_time': pretrain_time,
+                'finetune_time': time.time() - start - pretrain_time}
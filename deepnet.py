@@ -1,9 +1,14 @@
-import sys
-import os
-home = os.path.expanduser("~")
-sys.path.append(os.path.join(home, 'gnumpy'))
-import gnumpy as gp
 import numpy as np
+import time
+import threading
+import traceback
+import lazy
+import events
+import memplan
+import splitdata
+import transfers
+# gnumpy is imported the first time it is used
+gp = lazy.gnumpy
 
 class RBM(object):
     ''' 
@@ -19,6 +24,12 @@ class RBM(object):
         array hbias:      the bias weights for the hidden layer, default None
         array vbias:      the bias weights for the visible layer, default None
         int batch_size:   default 128
+        obj planner:      the memplan.MemoryPlanner that sizes the data chunks
+                          moved to the gpu, default memplan.default_planner()
+        rng:              an int seed or a numpy RandomState used to initialize
+                          the weights, default the global numpy random state
+        bool inference_only: don't allocate the weight update arrays until
+                          train is called, default False
 
         if W, hbias, vbias are left as None (default), they will be created and 
             initialized automatically.
@@ -37,9 +48,10 @@ class RBM(object):
     '''
 
     def __init__(self, n_visible, n_hidden=None, vistype='sigmoid', 
-            hidtype='sigmoid', W=None, hbias=None, vbias=None, batch_size=128):
+            hidtype='sigmoid', W=None, hbias=None, vbias=None, batch_size=128,
+            planner=None, rng=None, inference_only=False):
         # initialize parameters
-        self.SIZE_LIMIT = 80000000 # the size of the largest gpu array
+        self.planner = planner
         self.vistype = vistype
         self.hidtype = hidtype
         self.batch_size = batch_size
@@ -49,36 +61,48 @@ class RBM(object):
         self.n_hidden = n_hidden
         n = self.n_visible*self.n_hidden + self.n_hidden
         bound = 2.38 / np.sqrt(n)
+        rng = get_rng(rng)
         if W is None:
-            W = np.zeros((self.n_visible, self.n_hidden))
-            for i in range(self.n_visible):
-                for j in range(self.n_hidden):
-                    W[i,j] = np.random.uniform(-bound, bound)
-        W = gp.garray(W)
+            W = rng.uniform(-bound, bound, (self.n_visible, self.n_hidden))
+        W = transfers.to_device(W, 'RBM')
         self.W = W
         if vbias is None:
             vbias = gp.zeros(self.n_visible)
         else:
-            vbias = gp.garray(vbias)
+            vbias = transfers.to_device(vbias, 'RBM')
         self.vbias = vbias
         if hbias is None:
-            hbias = np.zeros((self.n_hidden,))
-            for i in range(self.n_hidden):
-                hbias[i] = np.random.uniform(-bound, bound)
-        hbias = gp.garray(hbias)
+            hbias = rng.uniform(-bound, bound, (self.n_hidden,))
+        hbias = transfers.to_device(hbias, 'RBM')
         self.hbias = hbias
-        #initialize updates
+        self.wu_vh = None
+        self.wu_v = None
+        self.wu_h = None
+        if not inference_only:
+            self.init_updates()
+
+    def init_updates(self):
+        '''
+        Allocates the weight update arrays used by train
+        '''
         self.wu_vh = gp.zeros((self.n_visible, self.n_hidden))
         self.wu_v = gp.zeros(self.n_visible)
         self.wu_h = gp.zeros(self.n_hidden)
 
     def train(self, fulldata, num_epochs, eta=0.01, hidden=None, sample=False, 
-            early_stop=True):
+            early_stop=True, callbacks=None, valid=None, monitor='reconstruction',
+            patience=10, valid_rows=1024, start_epoch=0):
         ''' 
         Method to learn the weights of the RBM.
 
         args: 
-            array fulldata: the training data
+            array fulldata: the training data, may be a splitdata.SplitData.
+                            On the host (the npmat backend) the batches stay
+                            split, and the products with the weights use
+                            split_dot and split_tdot. On the gpu each chunk is
+                            made dense as it is moved over, because the
+                            sparse products would run on the host and copy
+                            the weights back and forth every batch
             int num_epochs: the number of times to run through the training data
             float eta:      the learning rate, default 0.01
             array hidden:   optional array specifying the hidden representation
@@ -86,14 +110,60 @@ class RBM(object):
             bool sample:    specifies whether training should use sampling, 
                             default False
             bool early_stop: whether to use early stopping, default True
+            list callbacks: objects that receive the training events, see 
+                            events.Callback. Default prints progress, [] is silent
+            array valid:    held-out data. If given, early stopping watches the
+                            reconstruction error of a fixed sample of it after
+                            every epoch instead of the training error, stops
+                            once it hasn't improved for patience epochs, and
+                            restores the weights of the best epoch at the end
+            string monitor: 'reconstruction' (default) to stop on the held-out
+                            reconstruction error alone, or 'free_energy' to
+                            also track the gap between the mean free energy
+                            of the held-out sample and of a training sample
+                            of the same size, which grows as the RBM overfits.
+                            The gap also rises and falls while the RBM is
+                            still learning, so it doesn't choose the weights;
+                            training stops only once the reconstruction error
+                            has stalled and the gap has been above its minimum
+                            for patience epochs
+            int patience:   epochs without improvement before stopping,
+                            default 10
+            int valid_rows: the size of the held-out sample, default 1024
+            int start_epoch: the number of epochs already trained, for the
+                            momentum schedule and the event epoch numbers when
+                            training continues in several calls, default 0
 
         '''
+        emitter = events.emitter(callbacks)
+        if getattr(self, 'wu_vh', None) is None:
+            self.init_updates()
         if hidden is not None:
             # check that there is a hidden rep for each data row
-            assert hidden.shape[0] == data.shape[0]
+            assert hidden.shape[0] == fulldata.shape[0]
             # check that we have the right number of hidden units
             assert hidden.shape[1] == self.n_hidden
 
+        if valid is not None:
+            assert monitor in ('reconstruction', 'free_energy')
+            # fixed samples, evenly spread over the data and moved to the gpu once
+            inds = np.linspace(0, valid.shape[0]-1, min(valid_rows,
+                valid.shape[0])).astype(np.int)
+            valid_sample = transfers.to_device(splitdata.asarray(valid[inds]),
+                    'RBM.train')
+            if monitor == 'free_energy':
+                inds = np.linspace(0, fulldata.shape[0]-1, len(inds)).astype(np.int)
+                train_sample = transfers.to_device(splitdata.asarray(fulldata[inds]),
+                        'RBM.train')
+            # the snapshot of the best weights is allocated once and copied into
+            best_W = gp.zeros(self.W.shape)
+            best_hbias = gp.zeros(self.hbias.shape)
+            best_vbias = gp.zeros(self.vbias.shape)
+            best_score = np.inf
+            best_epoch = -1
+            best_gap = np.inf
+            gap_epoch = -1
+
         # these parameters control momentum changes
         initial_momentum = 0.5
         final_momentum = 0.9
@@ -101,27 +171,32 @@ class RBM(object):
 
         # when dealing with large arrays, we have to break the data into
         # manageable chunks to avoid out of memory err
-        if fulldata.size < self.SIZE_LIMIT:
-            n_chunks = 1
-            chunk_size = fulldata.shape[0]
-        else:
-            n_chunks = int(np.ceil(fulldata.size/float(self.SIZE_LIMIT)))
-            chunk_size = fulldata.shape[0]/n_chunks
+        planner = memplan.get_planner(getattr(self, 'planner', None))
+        chunk_rows = planner.chunk_rows(fulldata.shape[0], self.n_visible,
+                self.n_hidden, self.batch_size, hidden is not None)
+        n_chunks = int(np.ceil(fulldata.shape[0]/float(chunk_rows)))
+        chunk_size = fulldata.shape[0]/n_chunks
         
         num_batches = chunk_size/self.batch_size
+        # SplitData is only kept split when the products run on the host
+        split = isinstance(fulldata, splitdata.SplitData) and not memplan.on_gpu()
         err_hist = [] # keep track of the errors for early stopping
         for epoch in range(num_epochs):
-            if epoch <= momentum_iter:
+            if start_epoch + epoch <= momentum_iter:
                 momentum = initial_momentum
             else:
                 momentum = final_momentum
             err = []
-            print "Training epoch %d of %d," %(epoch+1, num_epochs),
+            epoch_start = time.time()
             for chunk in range(n_chunks):
+                chunk_start = time.time()
                 num_batches = chunk_size/self.batch_size
-                data = gp.garray(fulldata[chunk*chunk_size:(chunk+1)*chunk_size])
+                data = fulldata[chunk*chunk_size:(chunk+1)*chunk_size]
+                if not split:
+                    data = transfers.to_device(splitdata.asarray(data), 'RBM.train')
                 if hidden is not None:
-                    hid_chunk = gp.garray(hidden[chunk*chunk_size:(chunk+1)*chunk_size])
+                    hid_chunk = transfers.to_device(
+                            hidden[chunk*chunk_size:(chunk+1)*chunk_size], 'RBM.train')
 
                 for batch in range(num_batches):
                     # positive phase
@@ -140,36 +215,129 @@ class RBM(object):
                     h2 = self.prop_up(v2)
                 
                     # update weights
-                    self.wu_vh = self.wu_vh * momentum + gp.dot(v1.T, h1) - gp.dot(v2.T, h2)
-                    self.wu_v = self.wu_v * momentum + v1.sum(0) - v2.sum(0)
+                    if split:
+                        # a column of ones gives the sums of v1 in the same product
+                        pos = split_tdot(v1, gp.concatenate((h1,
+                            gp.ones((h1.shape[0], 1))), axis=1))
+                        pos_vh = pos[:, :-1]
+                        pos_v = pos[:, -1]
+                    else:
+                        pos_vh = gp.dot(v1.T, h1)
+                        pos_v = v1.sum(0)
+                    self.wu_vh = self.wu_vh * momentum + pos_vh - gp.dot(v2.T, h2)
+                    self.wu_v = self.wu_v * momentum + pos_v - v2.sum(0)
                     self.wu_h = self.wu_h * momentum + h1.sum(0) - h2.sum(0)
 
                     self.W += self.wu_vh * (eta/self.batch_size)
                     self.vbias += self.wu_v * (eta/self.batch_size)
                     self.hbias += self.wu_h * (eta/self.batch_size)
                     # calculate reconstruction error
-                    err.append((v2-v1).euclid_norm()**2/(self.n_visible*self.batch_size))
+                    if split:
+                        sq_err = v1.sq_error(transfers.to_host(v2, 'RBM.train'))
+                    else:
+                        sq_err = (v2-v1).euclid_norm()**2
+                    err.append(sq_err/(self.n_visible*self.batch_size))
+                    if emitter.batch_events:
+                        emitter.emit('batch', self, epoch=start_epoch+epoch, chunk=chunk,
+                                batch=batch, error=err[-1])
                 err_hist.append(np.mean(err))
-                print "mean squared error: "+ str(np.mean(err))
+                seconds = time.time() - chunk_start
+                emitter.emit('chunk', self, epoch=start_epoch+epoch, chunk=chunk,
+                        rows=num_batches*self.batch_size, seconds=seconds,
+                        rows_per_sec=num_batches*self.batch_size/max(seconds, 1e-9),
+                        error=np.mean(err[-num_batches:]))
+            seconds = time.time() - epoch_start
+            rows = n_chunks*num_batches*self.batch_size
+            fields = transfers.fields('epoch')
+            if valid is not None:
+                score = self.reconstruction_error(valid_sample)
+                if monitor == 'free_energy':
+                    gap = self.free_energy(valid_sample) - \
+                            self.free_energy(train_sample)
+                    if gap < best_gap:
+                        best_gap = gap
+                        gap_epoch = epoch
+                    fields['free_energy_gap'] = gap
+                if score < best_score:
+                    best_score = score
+                    best_epoch = epoch
+                    best_W[:] = self.W
+                    best_hbias[:] = self.hbias
+                    best_vbias[:] = self.vbias
+                fields['valid_score'] = score
+                fields['best_epoch'] = start_epoch + best_epoch
+            emitter.emit('epoch', self, epoch=start_epoch+epoch,
+                    num_epochs=start_epoch+num_epochs,
+                    rows=rows, seconds=seconds, rows_per_sec=rows/max(seconds, 1e-9),
+                    error=np.mean(err), momentum=momentum, **fields)
+            if emitter.stop:
+                break
             
             # early stopping
-            if early_stop:
+            if early_stop and (valid is not None):
+                stalled = epoch - best_epoch >= patience
+                if monitor == 'free_energy':
+                    stalled = stalled and (epoch - gap_epoch >= patience)
+                if stalled:
+                    break
+            elif early_stop and (epoch > 250):
                 recent_err = np.mean(err_hist[epoch-50:epoch])
                 early_err = np.mean(err_hist[epoch-200:epoch-150])
-                if (epoch > 250) and ((recent_err * 1.2) > early_err):
+                if (recent_err * 1.2) > early_err:
                     break
 
-    def prop_up(self, data):
+        if (valid is not None) and (best_epoch >= 0):
+            self.W[:] = best_W
+            self.hbias[:] = best_hbias
+            self.vbias[:] = best_vbias
+            emitter.emit('restore', self, best_epoch=start_epoch+best_epoch,
+                    valid_score=best_score)
+
+    def free_energy(self, data):
+        '''
+        Returns the mean free energy of the rows of data
+
+        args:
+            array data:  the data on the visible layer
+        returns:
+            float F:     the mean free energy
+        '''
+        act = gp.dot(data, self.W) + self.hbias
+        if self.vistype == 'sigmoid':
+            vis = -gp.dot(data, self.vbias)
+        else:
+            vis = 0.5*((data - self.vbias)**2).sum(1)
+        if self.hidtype == 'sigmoid':
+            hid = act.log_1_plus_exp().sum(1)
+        else:
+            hid = 0.5*(act**2).sum(1)
+        return float((vis - hid).mean())
+
+    def reconstruction_error(self, data):
+        '''
+        Returns the mean squared error of reconstructing the rows of data, as
+        in train
+        '''
+        recon = self.prop_down(self.prop_up(data))
+        return (recon - data).euclid_norm()**2/(self.n_visible*data.shape[0])
+
+    def prop_up(self, data, Wc=None):
         '''
         Method to return the hidden representation given data on the visible layer.
 
         args:
-            array data:         the data on the visible layer
+            array data:         the data on the visible layer, may be a
+                                splitdata.SplitData
+            array Wc:           for SplitData, a numpy copy of the weights of
+                                the sparse columns, see split_dot
         returns:
             array hid:   the probabilisitic activation of the hidden layer
         
         '''
-        hid = gp.dot(data, self.W) + self.hbias
+        if isinstance(data, splitdata.SplitData):
+            hid = split_dot(data, self.W, Wc) + self.hbias
+        else:
+            hid = gp.dot(data, self.W) + self.hbias
         if self.hidtype == 'sigmoid':
             return hid.logistic()
         else:
@@ -203,27 +371,153 @@ class RBM(object):
         hSampled = hid.rand() < hid
         return hSampled
 
+def get_rng(rng=None):
+    '''
+    Returns the random number generator to initialize weights with: the global
+    numpy random state for None, a new RandomState for an int seed, or rng
+    itself (e.g. a RandomState shared by the layers of a network)
+    '''
+    if rng is None:
+        return np.random
+    if isinstance(rng, (int, long)):
+        return np.random.RandomState(rng)
+    return rng
+
+def split_dot(data, W, Wc=None):
+    '''
+    Multiplies a splitdata.SplitData by the gnumpy weights W, shape (n_visible,
+    n_hidden): the dense part on the gpu, the sparse part on the host with
+    Wc, a numpy copy of the sparse rows W[n_dense:]. Callers that multiply
+    many blocks by the same W should copy Wc once and pass it in; by default
+    it is copied from W on every call.
+    '''
+    nd = data.n_dense
+    if Wc is None:
+        Wc = transfers.to_host(W[nd:], 'split_dot')
+    return gp.dot(transfers.to_device(data.dense, 'split_dot'), W[:nd]) + \
+            transfers.to_device(data.sparse_dot(Wc), 'split_dot')
+
+def split_tdot(data, H):
+    '''
+    Multiplies the transpose of a splitdata.SplitData by the gnumpy array H,
+    shape (n, n_hidden): the dense part on the gpu, the sparse part on the
+    host. Returns a gnumpy array of shape (n_visible, n_hidden)
+    '''
+    nd = data.n_dense
+    dense = gp.dot(transfers.to_device(data.dense, 'split_tdot').T, H)
+    sparse = data.sparse_tdot(transfers.to_host(H, 'split_tdot'))
+    return gp.concatenate((dense, transfers.to_device(sparse, 'split_tdot')), axis=0)
+
 class Holder(object):
     '''
     Objects of this class hold values of the RBMs in numpy arrays to free up space 
     on the GPU
     '''
     def __init__(self, rbm):
-        self.W = rbm.W.as_numpy_array()
-        self.hbias = rbm.hbias.as_numpy_array()
-        self.vbias = rbm.vbias.as_numpy_array()
+        self.W = transfers.to_host(rbm.W, 'Holder')
+        self.hbias = transfers.to_host(rbm.hbias, 'Holder')
+        self.vbias = transfers.to_host(rbm.vbias, 'Holder')
         self.n_hidden = rbm.n_hidden
         self.n_visible = rbm.n_visible
         self.hidtype = rbm.hidtype
         self.vistype = rbm.vistype
 
     def prop_up(self, data):
-        hid = np.dot(data, self.W) + self.hbias
+        if isinstance(data, splitdata.SplitData):
+            hid = data.dot(self.W) + self.hbias
+        else:
+            hid = np.dot(data, self.W) + self.hbias
         if self.hidtype == 'sigmoid':
             return 1./(1. + np.exp(-hid)) 
         else:
             return hid
 
+class Snapshot(object):
+    '''
+    The latest published state of one layer in DeepNet.train_pipelined: its
+    activations on the training data, for the layer above to train on. The
+    version counts publications; done is set by the final one.
+    '''
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.version = 0
+        self.hid = None
+        self.done = False
+
+    def publish(self, hid, done=False):
+        self.cond.acquire()
+        self.version += 1
+        self.hid = hid
+        self.done = done
+        self.cond.notify_all()
+        self.cond.release()
+
+    def get(self, version, wait=True):
+        '''
+        Returns (version, hid, done) for a publication newer than version,
+        waiting for one if wait is True, or None if there is none
+        '''
+        self.cond.acquire()
+        try:
+            while wait and (self.version <= version) and not self.done:
+                self.cond.wait(1.)
+            if self.version <= version:
+                return None
+            return self.version, self.hid, self.done
+        finally:
+            self.cond.release()
+
+class LayerWorker(threading.Thread):
+    '''
+    Trains one RBM of DeepNet.train_pipelined. It trains refresh epochs at a
+    time on the latest activations published by the layer below, publishing
+    its own activations after each round for the layer above.
+    '''
+    def __init__(self, dnn, rbm, source, slot, data, epochs, eta, refresh, emitter,
+            publish=True):
+        super(LayerWorker, self).__init__()
+        self.daemon = True
+        self.dnn = dnn
+        self.rbm = rbm
+        self.source = source
+        self.slot = slot
+        self.data = data
+        self.epochs = epochs
+        self.eta = eta
+        self.refresh = refresh
+        self.emitter = emitter
+        self.publish = publish
+        self.error = None
+
+    def run(self):
+        try:
+            version = 0
+            vis = self.data
+            if self.source is not None:
+                snapshot = self.source.get(version)
+                if snapshot is None:
+                    return
+                version, vis = snapshot[:2]
+            done = 0
+            while (done < self.epochs) and not self.emitter.stop:
+                n = min(self.refresh, self.epochs - done)
+                self.rbm.train(vis, n, self.eta, early_stop=False,
+                        callbacks=self.emitter, start_epoch=done)
+                done += n
+                if self.publish:
+                    self.slot.publish(self.dnn.get_activation(self.rbm, vis),
+                            done >= self.epochs)
+                if self.source is not None:
+                    snapshot = self.source.get(version, wait=False)
+                    if snapshot is not None:
+                        version, vis = snapshot[:2]
+        except Exception:
+            self.error = traceback.format_exc()
+        finally:
+            # never leave the layer above waiting
+            if self.publish and not self.slot.done:
+                self.slot.publish(self.slot.hid, True)
+
 class DeepNet(object):
     '''
     A class to implement a deep neural network
@@ -231,17 +525,29 @@ class DeepNet(object):
     args:
         list[int] layer_sizes: defines the number and size of layers 
         list[str] layer_types: defines layer types, 'sigmoid' or 'gaussian'
+        obj planner:           the memplan.MemoryPlanner used to size data
+                               chunks and inference blocks, default
+                               memplan.default_planner()
+        rng:                   an int seed or a numpy RandomState used to
+                               initialize the RBMs, default the global numpy
+                               random state
 
     methods: 
         train
         run_through_network
     '''
-    def __init__(self, layer_sizes, layer_types):
+    def __init__(self, layer_sizes, layer_types, planner=None, rng=None):
         assert len(layer_sizes) == len(layer_types)
         self.layer_sizes = layer_sizes
         self.layer_types = layer_types
+        self.planner = planner
+        # one generator for all the layers, so that they differ. Without a seed
+        # the RBMs use np.random, which isn't kept here so the net pickles
+        if rng is not None:
+            rng = get_rng(rng)
+        self.rng = rng
         
-    def train(self, data, epochs, eta):
+    def train(self, data, epochs, eta, callbacks=None, valid=None):
         '''
         Trains the deep net one RBM at a time
 
@@ -249,40 +555,135 @@ class DeepNet(object):
             array data:         the training data (a gnumpy.array)
             list[int] epochs:   the number of training epochs for each RBM
             float eta:          the learning rate
+            list callbacks:     objects that receive the training events, see
+                                events.Callback. Default prints progress
+            array valid:        held-out data for the early stopping of every
+                                RBM, see RBM.train. It is run up through each
+                                trained layer along with the training data
         '''
+        emitter = events.emitter(callbacks)
         layers = []
+        self.network = layers
         vis = data
         for i in range(len(self.layer_sizes)-1):
-            print "Pretraining RBM %d, vis=%d, hid=%d" % (i+1, self.layer_sizes[i],
-                    self.layer_sizes[i+1])
+            layer_start = time.time()
+            emitter.emit('layer_start', self, layer=i, n_visible=self.layer_sizes[i],
+                    n_hidden=self.layer_sizes[i+1])
             g_rbm = RBM(self.layer_sizes[i], self.layer_sizes[i+1], 
-                    self.layer_types[i], self.layer_types[i+1])
-            g_rbm.train(vis, epochs[i], eta)
+                    self.layer_types[i], self.layer_types[i+1],
+                    planner=getattr(self, 'planner', None),
+                    rng=getattr(self, 'rng', None))
+            g_rbm.train(vis, epochs[i], eta, callbacks=emitter, valid=valid)
             hid = self.get_activation(g_rbm, vis)
             vis = hid
+            if (valid is not None) and (i < len(self.layer_sizes)-2):
+                valid = self.get_activation(g_rbm, valid)
             n_rbm = Holder(g_rbm)
             layers.append(n_rbm)
-            gp.free_reuse_cache()
+            transfers.free_cache('DeepNet.train')
+            emitter.emit('layer', self, layer=i, seconds=time.time() - layer_start,
+                    **transfers.fields('layer'))
+            if emitter.stop:
+                break
+
+    def train_pipelined(self, data, epochs, eta, refresh=5, sync_epochs=None,
+            callbacks=None):
+        '''
+        Trains the deep net with the RBMs training at the same time, each in
+        its own thread. Every refresh epochs a layer publishes its activations
+        on the training data, and the layer above switches to them, so an
+        upper layer starts once the layer below has trained refresh epochs
+        instead of waiting for it to finish. When all the threads are done, a
+        synchronization pass runs the data up through the final weights and
+        trains each upper layer for sync_epochs more on its exact input.
+
+        The threads overlap because the matrix products release the GIL; this
+        helps on multi-core machines running the npmat backend. Each layer
+        keeps its own copy of its input, so memory use is that of all the
+        layer activations at once.
+
+        args:
+            array data:         the training data
+            list[int] epochs:   the number of training epochs for each RBM
+            float eta:          the learning rate
+            int refresh:        epochs between publications, default 5
+            int sync_epochs:    epochs of the synchronization pass, default
+                                refresh
+            list callbacks:     objects that receive the training events, see
+                                events.Callback. Default prints progress
+        '''
+        emitter = events.emitter(callbacks)
+        if sync_epochs is None:
+            sync_epochs = refresh
+        n_layers = len(self.layer_sizes)-1
+        rbms = []
+        for i in range(n_layers):
+            rbms.append(RBM(self.layer_sizes[i], self.layer_sizes[i+1],
+                self.layer_types[i], self.layer_types[i+1],
+                planner=getattr(self, 'planner', None), rng=getattr(self, 'rng', None)))
+        start = time.time()
+        workers = []
+        source = None
+        for i in range(n_layers):
+            emitter.emit('layer_start', self, layer=i, n_visible=self.layer_sizes[i],
+                    n_hidden=self.layer_sizes[i+1])
+            slot = Snapshot()
+            # the layers train at once, so their events say which one sent them
+            worker = LayerWorker(self, rbms[i], source, slot, data, epochs[i], eta,
+                    refresh, events.TaggedEmitter(emitter, layer=i), i < n_layers-1)
+            worker.start()
+            workers.append(worker)
+            source = slot
+        for worker in workers:
+            worker.join()
+        for worker in workers:
+            if worker.error is not None:
+                raise RuntimeError("pipelined layer failed:\n%s" % worker.error)
+        emitter.emit('pipeline', self, seconds=time.time() - start)
+
+        # synchronization pass through the final weights
+        layers = []
         self.network = layers
+        vis = data
+        for i in range(n_layers):
+            layer_start = time.time()
+            if (i > 0) and (sync_epochs > 0) and not emitter.stop:
+                rbms[i].train(vis, sync_epochs, eta, early_stop=False,
+                        callbacks=events.TaggedEmitter(emitter, layer=i),
+                        start_epoch=epochs[i])
+            if i < n_layers-1:
+                vis = self.get_activation(rbms[i], vis)
+            layers.append(Holder(rbms[i]))
+            transfers.free_cache('DeepNet.train_pipelined')
+            emitter.emit('layer', self, layer=i, seconds=time.time() - layer_start,
+                    **transfers.fields('layer'))
 
     def get_activation(self, rbm, data):
         # trying to prop_up the whole data set causes out of memory err
         hid = np.zeros((data.shape[0], rbm.n_hidden))
-        breaks = range(0, hid.shape[0], 128)
+        planner = memplan.get_planner(getattr(self, 'planner', None))
+        block = planner.block_rows(rbm.n_visible, rbm.n_hidden, hid.shape[0])
+        breaks = range(0, hid.shape[0], block)
         breaks.append(hid.shape[0])
+        Wc = None
+        if isinstance(data, splitdata.SplitData):
+            # the sparse rows of the weights are copied to the host once
+            Wc = transfers.to_host(rbm.W[data.n_dense:], 'DeepNet.get_activation')
         for i in range(len(breaks)-1):
             hid[breaks[i]:breaks[i+1]] = \
-                    (rbm.prop_up(data[breaks[i]:breaks[i+1]])).as_numpy_array()
+                    transfers.to_host(rbm.prop_up(data[breaks[i]:breaks[i+1]], Wc),
+                            'DeepNet.get_activation')
         return hid
 
     def run_through_network(self, data):
         hid = data
         for n_rbm in self.network:
-            vis = gp.garray(hid)
             g_rbm = RBM(n_rbm.n_visible, n_rbm.n_hidden, n_rbm.vistype, 
-                    n_rbm.hidtype, n_rbm.W, n_rbm.hbias, n_rbm.vbias)
-            hid = self.get_activation(g_rbm, data)
-            gp.free_reuse_cache()
+                    n_rbm.hidtype, n_rbm.W, n_rbm.hbias, n_rbm.vbias,
+                    inference_only=True)
+            # get_activation moves the data to the gpu a block at a time
+            hid = self.get_activation(g_rbm, hid)
+            transfers.free_cache('DeepNet.run_through_network')
         return hid
 
 
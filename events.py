@@ -0,0 +1,261 @@
+import time
+import json
+import os
+import cPickle as pickle
+
+class Callback(object):
+    '''
+    Base class for objects that receive training events. Training methods take
+    a list of callbacks and call each one with every event they emit.
+
+    An event is a dict with at least 'event' (the event name), 'time' (wall
+    clock time) and 'elapsed' (seconds since training started). The events
+    and their other fields are:
+
+        RBM.train:
+            batch:      epoch, chunk, batch, error (only sent if a callback
+                        has batch_events set)
+            chunk:      epoch, chunk, rows, seconds, rows_per_sec, error
+            epoch:      epoch, num_epochs, rows, seconds, rows_per_sec, error,
+                        momentum, and valid_score (the held-out
+                        reconstruction error) and best_epoch if there is
+                        held-out data, and free_energy_gap if the monitor
+                        is 'free_energy'
+            restore:    best_epoch, valid_score when the best weights are
+                        restored at the end of training with held-out data
+        DeepNet.train:
+            layer_start: layer, n_visible, n_hidden
+            layer:      layer, seconds
+        DeepNet.train_pipelined:
+            layer_start, and the RBM.train events of every layer with a
+            layer field added, then
+            pipeline:   seconds, when the concurrent training is done
+            layer:      layer, seconds, for each layer of the
+                        synchronization pass
+        NeuralNet.train:
+            start:      max_iter
+            iteration:  iteration, max_iter, rows, seconds, rows_per_sec, and
+                        train_error (and valid_error if there is validation
+                        data) after the iteration
+            cg_batch:   batch, nbatches, rows, seconds, rows_per_sec, success
+            final:      train_error, and valid_error if there is
+                        validation data
+
+    If transfers.enable() was called, the epoch, layer and iteration events
+    also have a 'transfers' field with the host/device transfer counts since
+    the previous event of the same name, see transfers.Accounting.
+
+    Returning True from a callback asks training to stop at the end of the
+    current epoch or backprop iteration.
+    '''
+    batch_events = False
+
+    def __call__(self, event, model=None):
+        return False
+
+class Printer(Callback):
+    '''
+    Prints training progress to the console. This is what the training methods
+    use when no callbacks are given.
+    '''
+    def __call__(self, event, model=None):
+        name = event['event']
+        if (name in ('epoch', 'restore')) and ('layer' in event):
+            print "RBM %d:" % (event['layer']+1),
+        if name == 'epoch':
+            if 'valid_score' in event:
+                print "Training epoch %d of %d, mean squared error: %s, held-out: %s" % \
+                        (event['epoch']+1, event['num_epochs'], str(event['error']),
+                        str(event['valid_score']))
+            else:
+                print "Training epoch %d of %d, mean squared error: %s" % \
+                        (event['epoch']+1, event['num_epochs'], str(event['error']))
+        elif name == 'restore':
+            print "Restored the weights of epoch %d, held-out: %s" % \
+                    (event['best_epoch']+1, str(event['valid_score']))
+        elif name == 'layer_start':
+            print "Pretraining RBM %d, vis=%d, hid=%d" % (event['layer']+1,
+                    event['n_visible'], event['n_hidden'])
+        elif name == 'start':
+            print "Starting %d iterations of backprop." % event['max_iter']
+        elif name == 'cg_batch':
+            if (event['batch']%10 == 0):
+                print "batch %d of %d. success: %s" %(event['batch']+1,
+                        event['nbatches'], str(event['success']))
+        elif name == 'iteration':
+            if 'valid_error' in event:
+                print "Iteration %3d: TrainErr = %4.3f, ValidErr = %4.3f" % \
+                        (event['iteration']+1, event['train_error'], event['valid_error'])
+            else:
+                print "Iteration %3d: TrainErr = %4.3f" % (event['iteration']+1,
+                        event['train_error'])
+        elif name == 'final':
+            if 'valid_error' in event:
+                print "Final        : TrainErr = %4.3f, ValidErr = %4.3f" % \
+                        (event['train_error'], event['valid_error'])
+            else:
+                print "Final        : TrainErr = %4.3f" % event['train_error']
+        return False
+
+class Recorder(Callback):
+    '''
+    Keeps events in memory
+
+    args:
+        list[str] names:    the events to keep, default all of them
+        bool batch_events:  whether to ask for batch events, default False
+    '''
+    def __init__(self, names=None, batch_events=False):
+        self.names = names
+        self.batch_events = batch_events
+        self.events = []
+
+    def __call__(self, event, model=None):
+        if (self.names is None) or (event['event'] in self.names):
+            self.events.append(event)
+        return False
+
+    def get(self, name, field=None):
+        '''
+        returns the events called name, or just their field values
+        '''
+        events = [e for e in self.events if e['event'] == name]
+        if field is None:
+            return events
+        return [e[field] for e in events]
+
+class JSONLines(Callback):
+    '''
+    Writes each event as a line of JSON.
+
+    args:
+        string filename:    the file to append to
+        list[str] names:    the events to write, default all of them
+        bool batch_events:  whether to ask for batch events, default False
+    '''
+    def __init__(self, filename, names=None, batch_events=False):
+        self.filename = filename
+        self.names = names
+        self.batch_events = batch_events
+        self.f = None
+
+    def __call__(self, event, model=None):
+        if (self.names is None) or (event['event'] in self.names):
+            if self.f is None:
+                self.f = open(self.filename, 'a')
+            self.f.write(json.dumps(event, default=float) + '\n')
+            if event['event'] != 'batch':
+                self.f.flush()
+        return False
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+class Checkpoint(Callback):
+    '''
+    Pickles the model every n events of the given name
+
+    args:
+        string filename:    where to save, may contain %(epoch)d style fields
+                            of the event
+        string name:        the event to checkpoint on, default 'epoch'
+        int every:          save every this many events
+    '''
+    def __init__(self, filename, name='epoch', every=1):
+        self.filename = filename
+        self.name = name
+        self.every = every
+        self.count = 0
+
+    def __call__(self, event, model=None):
+        if event['event'] == self.name and model is not None:
+            self.count += 1
+            if self.count % self.every == 0:
+                pickle.dump(model, file(self.filename % event, 'wb'))
+        return False
+
+class StopFile(Callback):
+    '''
+    Stops training from outside: training stops once the file exists
+
+    args:
+        string filename:    the file to look for
+        list[str] names:    the events at which to check, default epoch and
+                            iteration
+    '''
+    def __init__(self, filename, names=('epoch', 'iteration')):
+        self.filename = filename
+        self.names = names
+
+    def __call__(self, event, model=None):
+        if event['event'] in self.names:
+            return os.path.exists(self.filename)
+        return False
+
+class Emitter(object):
+    '''
+    Sends events to a list of callbacks, and remembers whether any of them
+    asked to stop. Used by the training methods.
+
+    args:
+        list[Callback] callbacks:   the callbacks, default [Printer()]
+    '''
+    def __init__(self, callbacks=None):
+        if callbacks is None:
+            callbacks = [Printer()]
+        self.callbacks = list(callbacks)
+        self.batch_events = any([cb.batch_events for cb in self.callbacks])
+        self.start = time.time()
+        self.stop = False
+
+    def emit(self, name, model=None, **fields):
+        if len(self.callbacks) == 0:
+            return self.stop
+        now = time.time()
+        fields['event'] = name
+        fields['time'] = now
+        fields['elapsed'] = now - self.start
+        for cb in self.callbacks:
+            if cb(fields, model):
+                self.stop = True
+        return self.stop
+
+class TaggedEmitter(Emitter):
+    '''
+    Passes events on to another Emitter with extra fields added, e.g. the
+    layer of each RBM that DeepNet.train_pipelined trains at the same time.
+    Stopping is shared with the other Emitter.
+
+    args:
+        Emitter parent:     the Emitter to send the events to
+        fields:             the fields to add to every event
+    '''
+    def __init__(self, parent, **fields):
+        self.parent = parent
+        self.fields = fields
+        self.callbacks = parent.callbacks
+        self.batch_events = parent.batch_events
+        self.start = parent.start
+
+    def get_stop(self):
+        return self.parent.stop
+
+    def set_stop(self, stop):
+        self.parent.stop = stop
+
+    stop = property(get_stop, set_stop)
+
+    def emit(self, name, model=None, **fields):
+        fields.update(self.fields)
+        return self.parent.emit(name, model, **fields)
+
+def emitter(callbacks):
+    '''
+    Returns an Emitter for callbacks, which may already be an Emitter (e.g. when
+    DeepNet.train passes its own on to RBM.train)
+    '''
+    if isinstance(callbacks, Emitter):
+        return callbacks
+    return Emitter(callbacks)
@@ -0,0 +1,362 @@
+import numpy as np
+import multiprocessing
+import mmap
+import copy
+import time
+import traceback
+import memplan
+import crossval
+import splitdata
+
+class InferenceLayer(object):
+    '''
+    A layer that only runs forward, holding its weights in numpy arrays.
+    Objects of this class are made by export_network, and don't need gnumpy.
+
+    args:
+        array W:        the 2d weight matrix, shape (n_visible, n_hidden)
+        array hbias:    the bias weights for the hidden layer
+        string hidtype: the activation function "sigmoid" or "gaussian"
+    '''
+    def __init__(self, W, hbias, hidtype, dtype=np.float32):
+        self.W = np.ascontiguousarray(W, dtype=dtype)
+        self.hbias = np.asarray(hbias, dtype=dtype).reshape((-1,))
+        self.n_visible, self.n_hidden = self.W.shape
+        self.hidtype = hidtype
+
+    def nbytes(self):
+        return self.W.nbytes + self.hbias.nbytes
+
+    def prop_up(self, data):
+        if isinstance(data, splitdata.SplitData):
+            hid = data.dot(self.W)
+        else:
+            hid = np.dot(data, self.W)
+        hid += self.hbias
+        if self.hidtype == 'sigmoid':
+            # 1/(1+exp(-hid)) without temporaries
+            np.negative(hid, hid)
+            np.exp(hid, hid)
+            hid += 1.
+            np.reciprocal(hid, hid)
+        return hid
+
+def _as_numpy(a):
+    # gnumpy arrays are copied back from the gpu, numpy arrays are used as is
+    if hasattr(a, 'as_numpy_array'):
+        return a.as_numpy_array()
+    return np.asarray(a)
+
+def export_network(network, dtype=np.float32):
+    '''
+    Converts a trained network into InferenceLayers. Accepts the layers of a
+    DeepNet (DeepNet.network) as well as the layers of a NeuralNet, including
+    unrolled autoencoders.
+
+    args:
+        list[obj] network:  the trained layers
+        dtype dtype:        the type of the exported weights, default float32
+    returns:
+        list[InferenceLayer] layers: the exported network
+    '''
+    layers = []
+    for layer in network:
+        W = _as_numpy(layer.W)
+        hbias = _as_numpy(layer.hbias)
+        if not hasattr(layer, 'n_visible'):
+            # backprop layers store W as (n_hidden, n_visible)
+            W = W.T
+        layers.append(InferenceLayer(W, hbias, layer.hidtype, dtype))
+    return layers
+
+def save_network(layers, filename):
+    '''
+    Saves exported layers to a .npz file, using the same names as
+    autoencoder.save_net_as_mat: W1, b1, hidtype1, ... Loading them back with
+    load_network needs only numpy, not the training modules.
+    '''
+    mdic = {}
+    for i in range(len(layers)):
+        mdic['W%d'%(i+1)] = layers[i].W
+        mdic['b%d'%(i+1)] = layers[i].hbias
+        mdic['hidtype%d'%(i+1)] = layers[i].hidtype
+    np.savez(filename, **mdic)
+
+def load_network(filename, dtype=np.float32):
+    '''
+    Loads a network saved by save_network
+    '''
+    mdic = np.load(filename)
+    layers = []
+    i = 1
+    while ('W%d'%i) in mdic:
+        layers.append(InferenceLayer(mdic['W%d'%i], mdic['b%d'%i],
+            str(mdic['hidtype%d'%i]), dtype))
+        i += 1
+    return layers
+
+def run_network(layers, data, block=None):
+    '''
+    Gets the output of the top layer given input data on the bottom, working
+    through the data a block of rows at a time.
+
+    args:
+        list[obj] layers:   the network, e.g. from export_network
+        array data:         the input data
+        int block:          the number of rows to run at once, default from
+                            memplan.default_planner()
+    returns:
+        array hid:          the activation of the top layer
+    '''
+    dtype = layers[0].hbias.dtype
+    out = np.zeros((data.shape[0], layers[-1].n_hidden), dtype=dtype)
+    _run_rows(layers, data, out, 0, data.shape[0], block)
+    return out
+
+def _run_rows(layers, data, out, start, stop, block=None):
+    # runs rows start:stop of data through layers into the same rows of out
+    if block is None:
+        planner = memplan.default_planner()
+        block = min([planner.block_rows(l.n_visible, l.n_hidden, stop - start,
+            device=False) for l in layers])
+    dtype = layers[0].hbias.dtype
+    for s in range(start, stop, block):
+        e = min(s + block, stop)
+        hid = data[s:e]
+        if not isinstance(hid, splitdata.SplitData):
+            hid = np.asarray(hid, dtype=dtype)
+        for layer in layers:
+            hid = layer.prop_up(hid)
+        out[s:e] = hid
+
+def share_network(layers):
+    '''
+    Copies the weights of exported layers (from export_network or
+    quantize.quantize_network) into shared memory, so the worker processes
+    started by run_sharded all read one copy of them.
+
+    returns:
+        list[obj] layers:   copies of the layers with their arrays shared
+    '''
+    shared = []
+    for layer in layers:
+        layer = copy.copy(layer)
+        for name, value in vars(layer).items():
+            if isinstance(value, np.ndarray) and \
+                    crossval.shared_buffer(value) is None:
+                arr = crossval.shared_array(value.shape, value.dtype)
+                arr[:] = value
+                setattr(layer, name, arr)
+        shared.append(layer)
+    return shared
+
+def _share_array(arr, copy=True):
+    '''
+    Finds the shared memory or the file that arr lives in, and copies arr into
+    shared memory if it lives in neither and copy is True
+
+    returns:
+        tuple spec:     what _attach_array needs to make arr again in a worker
+                        process, without relying on fork, or None
+    '''
+    if isinstance(arr, np.memmap) and isinstance(arr.base, mmap.mmap) and \
+            arr.flags['C_CONTIGUOUS']:
+        # the file is opened again, without truncating it
+        mode = {'w+': 'r+'}.get(arr.mode, arr.mode)
+        return ('file', arr.filename, arr.offset, arr.shape, arr.dtype, mode)
+    shared = crossval.shared_buffer(arr)
+    if shared is None:
+        if not copy:
+            return None
+        shared = crossval.shared_array(arr.shape, arr.dtype)
+        shared[:] = arr
+        shared = crossval.shared_buffer(shared)
+    raw, offset = shared
+    return ('shared', raw, offset, arr.shape, arr.dtype)
+
+def _attach_array(spec):
+    # makes the array described by a spec from _share_array
+    if spec[0] == 'file':
+        filename, offset, shape, dtype, mode = spec[1:]
+        return np.memmap(filename, dtype=dtype, mode=mode, offset=offset,
+                shape=shape)
+    raw, offset, shape, dtype = spec[1:]
+    return crossval.from_shared(raw, offset, shape, dtype)
+
+def _share_data(data):
+    '''
+    Shares the input data of run_sharded with the workers. A splitdata.SplitData
+    is shared as its dense block and the arrays of its sparse block, and a
+    loadData.ByteRows as its raw bytes, so both are rebuilt in the workers
+    without being densified or normalized first.
+    '''
+    if isinstance(data, splitdata.SplitData):
+        sparse = data.sparse.tocsr()
+        return ('split', _share_array(np.asarray(data.dense)),
+                _share_array(sparse.data), _share_array(sparse.indices),
+                _share_array(sparse.indptr), sparse.shape, data.offset)
+    if hasattr(data, 'rewrap'):
+        return ('rewrap', _share_array(data.raw), data.rewrap)
+    if not isinstance(data, np.ndarray):
+        data = np.asarray(data)
+    return ('array', _share_array(data))
+
+def _attach_data(spec):
+    # makes the input data again from a spec made by _share_data
+    if spec[0] == 'split':
+        import scipy.sparse
+        dense, values, indices, indptr = [_attach_array(s) for s in spec[1:5]]
+        sparse = scipy.sparse.csr_matrix((values, indices, indptr),
+                shape=spec[5], copy=False)
+        return splitdata.SplitData(dense, sparse, spec[6])
+    if spec[0] == 'rewrap':
+        return spec[2](_attach_array(spec[1]))
+    return _attach_array(spec[1])
+
+class InferenceWorker(multiprocessing.Process):
+    '''
+    Runs the shards of rows taken from WorkQueue through the network, writing
+    the output rows straight into out, and puts the shard number, rows, wall
+    time and any traceback on ResultsQueue. The layers, data and out are given
+    as the specs made by _share_array and _share_data, and are attached to
+    shared memory or memory mapped again when the worker starts.
+    '''
+    def __init__(self, WorkQueue, ResultsQueue, layers, data, out, block):
+        super(InferenceWorker, self).__init__()
+        self.WorkQueue = WorkQueue
+        self.ResultsQueue = ResultsQueue
+        self.layers = layers
+        self.data = data
+        self.out = out
+        self.block = block
+
+    def run(self):
+        layers = []
+        for layer, arrays in self.layers:
+            layer = copy.copy(layer)
+            for name, spec in arrays.items():
+                setattr(layer, name, _attach_array(spec))
+            layers.append(layer)
+        data = _attach_data(self.data)
+        out = _attach_array(self.out)
+        flag = 'ok'
+        while (flag != 'stop'):
+            args = self.WorkQueue.get()
+            if args == None:
+                flag = 'stop'
+            else:
+                shard, start, stop = args
+                result = {'shard': shard, 'rows': stop - start, 'traceback': None}
+                t = time.time()
+                try:
+                    _run_rows(layers, data, out, start, stop, self.block)
+                    if isinstance(out, np.memmap):
+                        out.flush()
+                except Exception:
+                    result['traceback'] = traceback.format_exc()
+                result['time'] = time.time() - t
+                self.ResultsQueue.put(result)
+
+def run_sharded(layers, data, out=None, num_workers=None, shard_rows=None,
+        block=None):
+    '''
+    Runs a large data set through a network using a pool of processes, e.g.
+    for labelling archived sessions offline:
+
+        layers = share_network(export_network(nn.network))
+        data = np.load('frames.npy', mmap_mode='r')
+        out, report = run_sharded(layers, data, 'labels.npy')
+        print report['rows_per_sec']
+
+    The rows are split into shards that the workers take in turn. The workers
+    read the weights and the data from shared memory (or a memory mapped
+    file), and write their rows directly into out, so nothing is copied
+    between processes. Each worker also runs BLAS, so set OMP_NUM_THREADS=1
+    (or the MKL/OpenBLAS equivalent) before starting python to keep the
+    workers from competing for cores.
+
+    args:
+        list[obj] layers:   the network, e.g. from export_network, ideally
+                            already passed through share_network
+        array data:         the input data. Arrays that aren't memory mapped
+                            or made with crossval.shared_array are copied into
+                            shared memory once. A splitdata.SplitData or a
+                            loadData.ByteRows is shared in its compact form.
+        out:                where to write the output: None for a new shared
+                            array, a filename for a new .npy file that is
+                            memory mapped, or an existing shared or memory
+                            mapped array
+        int num_workers:    number of processes, default the number of cpus
+        int shard_rows:     rows per shard, default enough for 4 shards per
+                            worker
+        int block:          rows run through the network at once by a worker,
+                            default from memplan.default_planner()
+    returns:
+        array out:          the activation of the top layer
+        dict report:        rows, seconds, rows_per_sec, workers and shards
+    '''
+    start = time.time()
+    n_rows = data.shape[0]
+    dtype = layers[0].hbias.dtype
+    shape = (n_rows, layers[-1].n_hidden)
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    if shard_rows is None:
+        shard_rows = int(np.ceil(n_rows / float(4*num_workers)))
+    shard_rows = max(shard_rows, 1)
+    # the workers get the shared memory and files, not the arrays, and
+    # attach to them themselves
+    shared_layers = []
+    for layer in share_network(layers):
+        arrays = {}
+        for name, value in vars(layer).items():
+            if isinstance(value, np.ndarray):
+                arrays[name] = _share_array(value)
+        layer = copy.copy(layer)
+        for name in arrays:
+            setattr(layer, name, None)
+        shared_layers.append((layer, arrays))
+    shared_data = _share_data(data)
+    if out is None:
+        out = crossval.shared_array(shape, dtype)
+    elif isinstance(out, basestring):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+    assert out.shape == shape
+    shared_out = _share_array(out, copy=False)
+    if shared_out is None:
+        raise ValueError('out must be a shared or memory mapped array')
+
+    WorkQueue_ = multiprocessing.Queue()
+    ResultsQueue_ = multiprocessing.Queue()
+    breaks = range(0, n_rows, shard_rows)
+    breaks.append(n_rows)
+    n_shards = len(breaks) - 1
+    num_workers = max(min(num_workers, n_shards), 1)
+    workers = []
+    for i in range(num_workers):
+        worker = InferenceWorker(WorkQueue_, ResultsQueue_, shared_layers,
+                shared_data, shared_out, block)
+        worker.start()
+        workers.append(worker)
+
+    for k in range(n_shards):
+        WorkQueue_.put((k, breaks[k], breaks[k+1]))
+    for i in range(num_workers):
+        WorkQueue_.put(None)
+
+    failed = []
+    for k in range(n_shards):
+        result = ResultsQueue_.get()
+        if result['traceback'] is not None:
+            failed.append(result)
+    for worker in workers:
+        worker.join()
+    if len(failed) > 0:
+        raise RuntimeError("shard %d failed:\n%s" % (failed[0]['shard'],
+            failed[0]['traceback']))
+
+    seconds = time.time() - start
+    report = {'rows': n_rows, 'seconds': seconds,
+            'rows_per_sec': n_rows/max(seconds, 1e-9), 'workers': num_workers,
+            'shards': n_shards}
+    return out, report
@@ -0,0 +1,45 @@
+import sys
+import os
+import importlib
+
+class LazyModule(object):
+    '''
+    Stands in for a module that is only imported the first time one of its
+    attributes is used, so that importing e.g. deepnet doesn't load gnumpy
+    (and cudamat or npmat) until something is trained or run on it.
+
+    args:
+        string name:    the name of the module
+        string path:    a directory to add to sys.path before importing it,
+                        default None
+    '''
+    def __init__(self, name, path=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_path'] = path
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            if (self._path is not None) and (self._path not in sys.path):
+                sys.path.append(self._path)
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def loaded(self):
+        '''
+        returns whether the module has been imported yet
+        '''
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        value = getattr(self._load(), attr)
+        if callable(value):
+            # functions and classes are kept, so later uses skip this lookup
+            self.__dict__[attr] = value
+        return value
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+home = os.path.expanduser("~")
+gnumpy = LazyModule('gnumpy', os.path.join(home, 'gnumpy'))
@@ -1,10 +1,8 @@
 import numpy as np
 import os
-import cv
-from scipy.interpolate import interp1d
-from scipy.misc import imresize
 import multiprocessing
 import sys
+import splitdata
 
 class WorkThread(multiprocessing.Process):
     def __init__(self, WorkQueue, ResultsQueue):
@@ -34,8 +32,98 @@ class WorkThread(multiprocessing.Process):
                 self.ResultsQueue.put((contimg, ind))
 
 
+class ByteRows(object):
+    '''
+    A read-only view of a data set stored as uint8 pixels (0-255). Rows are
+    converted to float32, scaled to [0, 1] and normalized with m and s only
+    when they are indexed, so training reads it a chunk at a time without a
+    full float copy ever being made. Supports the operations used by
+    RBM.train, DeepNet.train, NeuralNet.train and inference: shape, size,
+    and row indexing with ints, slices or arrays, like crossval.FoldView.
+
+    args:
+        array raw:      the uint8 rows
+        array m, s:     the mean and sd to normalize with, or None to only
+                        scale to [0, 1]
+    '''
+    def __init__(self, raw, m=None, s=None):
+        self.raw = raw
+        self.m = m
+        self.s = s
+        self.shape = raw.shape
+        self.size = raw.size
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def normalize(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        X /= 255.
+        if self.m is not None:
+            X -= self.m
+            X /= self.s
+        return X
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows = key[0]
+            rest = key[1:]
+        else:
+            rows = key
+            rest = ()
+        out = self.normalize(self.raw[rows])
+        if len(rest) > 0:
+            if np.isscalar(rows):
+                out = out[rest]
+            else:
+                out = out[(slice(None),) + rest]
+        return out
+
+    def __array__(self, dtype=None):
+        out = self.normalize(self.raw)
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
+
+    def rewrap(self, raw):
+        '''
+        returns a ByteRows with the same normalization over raw, e.g. a copy
+        of self.raw in shared memory
+        '''
+        return ByteRows(raw, self.m, self.s)
+
 class Loader:
-    def __init__(self, data_dir, roi=None, max_images=None, num_threads=2, continds=None, m=None, s=None):
+    '''
+    Loads the ultrasound images and traces for one subject and formats them into
+    a data set for training.
+
+    args:
+        string data_dir:  directory containing TongueContours.csv and JPG/
+        list[int] roi:    [top, bottom, left, right], default None reads
+                          ROI_config.txt or uses the Sonosite Titan defaults.
+                          'auto' uses autoROI() around the traced region
+        int max_images:   randomly sample at most this many images
+        int num_threads:  number of processes used to make contour images
+        array continds:   indices of the contour pixels to keep
+        array m, s:       mean and sd used for normalization, computed from the
+                          data if None
+        dtype dtype:      storage type of XC, default float32. With uint8 the raw
+                          pixels are kept and XC is a ByteRows, which
+                          normalizes rows on the fly as they are read
+        string contour_format: 'dense' (default) or 'sparse'. With 'sparse', XC
+                          is a splitdata.SplitData that keeps the contour pixels
+                          in a CSR matrix, dropping values below 0.01
+        tuple shape:      (height, width) of the data images, default a tenth
+                          of the roi size. Set it, with continds and extents,
+                          to format several subjects the same way (see
+                          corpus.py)
+        tuple extents:    (minx, miny, maxx, maxy), the image region the
+                          contour images span, default the extents of this
+                          subject's traces
+    '''
+    def __init__(self, data_dir, roi=None, max_images=None, num_threads=2, continds=None, m=None, s=None,
+            dtype=np.float32, contour_format='dense', shape=None, extents=None):
         self.jpg_dir = os.path.join(data_dir, 'JPG')
         self.contoursCSV = os.path.join(data_dir, 'TongueContours.csv')
         self.data_dir = data_dir
@@ -44,7 +132,12 @@ class Loader:
         self.num_threads = num_threads
         self.continds = continds
         self.m = m
-        self.s = s	
+        self.s = s
+        self.dtype = np.dtype(dtype)
+        assert contour_format in ('dense', 'sparse')
+        self.contour_format = contour_format
+        self.shape = shape
+        self.extents = extents
                 
     def loadContours(self):
         ''' Returns lists with jpg filenames, xcoords, and ycoords from the 
@@ -93,16 +186,20 @@ class Loader:
                 self.miny: the global y min 
                 self.maxx: the global x max 
                 self.maxy: the global y max 
+                or self.extents if it was given
         '''
         self.cxc = []
         self.cyc = []
         for i in range(len(self.contx)):
             self.cxc.append(self.contx[i, self.contx[i,:]>0])
             self.cyc.append(self.conty[i, self.conty[i,:]>0])
-        self.minx = np.min(self.contx[self.contx>0])
-        self.miny = np.min(self.conty[self.conty>0])
-        self.maxx = np.max(self.contx)
-        self.maxy = np.max(self.conty)
+        if self.extents is not None:
+            self.minx, self.miny, self.maxx, self.maxy = self.extents
+        else:
+            self.minx = np.min(self.contx[self.contx>0])
+            self.miny = np.min(self.conty[self.conty>0])
+            self.maxx = np.max(self.contx)
+            self.maxy = np.max(self.conty)
         
     def makeContourImages(self):
         ''' Similar to makeContourImages.m - takes the cxc and cyc and makes 
@@ -111,6 +208,7 @@ class Loader:
             computes:
                 self.contimgs: the list of 2D contour images
         '''
+        from scipy.interpolate import interp1d
         self.contimgs = []
         interprows = self.maxy-self.miny+1
         interpcols = self.maxx-self.minx+1
@@ -155,19 +253,128 @@ class Loader:
         sortedresults = sorted(results, key = lambda r: r[1])
         self.contimgs = [i for (i,j) in sortedresults]
         
-    def combineUltrasoundAndContourImages(self, sigmoid=False):
-        ''' Similar to combineUltrasoundAndContourImages.m - returns an array with
-            concatenated ultrasound images and their traces from makeContourImages.
-            
+    def scanContours(self, shape=None, margin=20):
+        ''' Makes one streaming pass over TongueContours.csv, without loading
+            the traces into memory or rasterizing contour images. The trace
+            points are counted at pixel resolution and binned into the grid
+            that combineUltrasoundAndContourImages uses for the contour images,
+            which spans the contour extents.
+
+            args:
+                tuple shape:  (height, width) of the grid, default the size of
+                              the data images, self.shape or from the roi
+                int margin:   the margin used if the roi is 'auto'
             computes:
-                self.XC: the 2D data set of rasterized ultrasound and contour images
-                self.m: the mean of XC
-                self.s: the sd of XC
-                self.height: the height of the ultrasound image roi
-                self.width: the width of the ultrasound image roi
-                self.continds: the non-zero elements of contimgs
+                self.minx, self.miny, self.maxx, self.maxy: the contour extents,
+                              as in cleanContours, or self.extents if given
+                self.trace_extents: the extents of the traces themselves
+                self.ncontours: the number of traces
+                self.heatmap: how often the traces cross each grid cell, scaled
+                              to a maximum of 1
+                self.contmask: the grid cells the traces pass through, widened
+                              by one cell above and below for the width of the
+                              contour ridges
+                self.continds: the indices of the contour pixels to keep, if
+                              shape is None and continds wasn't given
+            Raises ValueError if the file has no traces.
         '''
-        # figure out what ROI to use
+        counts = np.zeros((1, 1))
+        self.ncontours = 0
+        minx = miny = np.inf
+        maxx = maxy = 0
+        f = open(self.contoursCSV, 'r')
+        f.readline()
+        for line in f:
+            cells = line.rstrip('\r\n').split('\t')
+            if len(cells) < 65:
+                continue
+            x = np.asarray([int(c) for c in cells[1:65:2]])
+            y = np.asarray([int(c) for c in cells[2:65:2]])
+            self.ncontours += 1
+            maxx = max(maxx, np.max(x))
+            maxy = max(maxy, np.max(y))
+            keep = (x > 0) & (y > 0)
+            if not np.any(keep):
+                continue
+            x = x[keep]
+            y = y[keep]
+            minx = min(minx, np.min(x))
+            miny = min(miny, np.min(y))
+            order = np.argsort(x, kind='mergesort')
+            xi = np.arange(x[order[0]], x[order[-1]]+1)
+            yi = np.round(np.interp(xi, x[order], y[order])).astype(np.int)
+            if (np.max(yi) >= counts.shape[0]) or (xi[-1] >= counts.shape[1]):
+                # grow the counts to fit, with room to spare
+                grown = np.zeros((max(counts.shape[0], 2*np.max(yi)+1),
+                    max(counts.shape[1], 2*xi[-1]+1)))
+                grown[:counts.shape[0], :counts.shape[1]] = counts
+                counts = grown
+            counts[yi, xi] += 1
+        f.close()
+        if np.isinf(minx):
+            raise ValueError("no tongue traces in %s" % self.contoursCSV)
+        self.trace_extents = (int(minx), int(miny), int(maxx), int(maxy))
+        if self.extents is not None:
+            self.minx, self.miny, self.maxx, self.maxy = self.extents
+        else:
+            self.minx, self.miny, self.maxx, self.maxy = self.trace_extents
+
+        if self.roi == 'auto':
+            self.roi = self.autoROI(margin)
+        data_shape = shape is None
+        if data_shape and (self.shape is not None):
+            shape = self.shape
+        elif data_shape:
+            top, bottom, left, right = self.getROI()
+            shape = (int(np.floor((bottom - top) * 0.1)),
+                    int(np.floor((right - left) * 0.1)))
+        height, width = shape
+
+        # the contour image row k is y = miny + k - 1 and column j is x = minx + j
+        interprows = self.maxy - self.miny + 1
+        interpcols = self.maxx - self.minx + 1
+        grid = counts[max(self.miny-1, 0):self.maxy+1, self.minx:self.maxx+1]
+        offset = max(self.miny-1, 0) - (self.miny-1)
+        rows = np.minimum((np.arange(grid.shape[0]) + offset) * height / interprows,
+                height - 1)
+        cols = np.minimum(np.arange(grid.shape[1]) * width / interpcols, width - 1)
+        heatmap = np.zeros((height, width))
+        np.add.at(heatmap, (rows[:, np.newaxis], cols[np.newaxis, :]), grid)
+        mask = heatmap > 0
+        mask[1:] |= heatmap[:-1] > 0
+        mask[:-1] |= heatmap[1:] > 0
+        self.heatmap = heatmap / max(np.max(heatmap), 1)
+        self.contmask = mask
+        if data_shape and (self.continds is None):
+            self.continds = np.arange(height*width)[mask.reshape((height*width,))]
+
+    def autoROI(self, margin=20):
+        ''' Derives the region of the ultrasound images to use from the contour
+            extents found by scanContours or cleanContours, plus a margin.
+
+            args:
+                int margin:   pixels added on every side
+            returns:
+                tuple roi: (top, bottom, left, right)
+        '''
+        if not hasattr(self, 'maxy'):
+            self.scanContours(shape=(1, 1))
+        top = max(self.miny - margin, 0)
+        bottom = self.maxy + margin
+        left = max(self.minx - margin, 0)
+        right = self.maxx + margin
+        return top, bottom, left, right
+
+    def getROI(self):
+        ''' Figures out which region of the ultrasound images to use: self.roi if
+            given, else ROI_config.txt in data_dir, else the defaults for the
+            Sonosite Titan. If self.roi is 'auto', autoROI() is used.
+
+            returns:
+                tuple roi: (top, bottom, left, right)
+        '''
+        if self.roi == 'auto':
+            self.roi = self.autoROI()
         if self.roi == None:
             if os.path.isfile(os.path.join(self.data_dir, 'ROI_config.txt')):
                 print "Found ROI_config.txt"
@@ -190,6 +397,46 @@ class Loader:
             left = self.roi[2]
             right = self.roi[3]
             print "using ROI: [%d:%d, %d:%d]" % (top, bottom, left, right)
+        return top, bottom, left, right
+
+    def scaleImage(self, img, roi):
+        ''' Crops an ultrasound image to the roi and resizes it to 
+            (self.height, self.width)
+
+            args:
+                array img:  the 2D grayscale image
+                tuple roi:  (top, bottom, left, right)
+            returns:
+                array ultrasound: the flattened image, scaled to [0, 1]
+        '''
+        from scipy.misc import imresize
+        top, bottom, left, right = roi
+        cropped = img[top:bottom, left:right]
+        resized = imresize(cropped, (self.height, self.width), interp='bicubic') 
+        scaled = np.double(resized)/255
+        return scaled.reshape((self.height*self.width,))
+
+    def combineUltrasoundAndContourImages(self, sigmoid=False):
+        ''' Similar to combineUltrasoundAndContourImages.m - returns an array with
+            concatenated ultrasound images and their traces from makeContourImages.
+            
+            computes:
+                self.XC: the 2D data set of rasterized ultrasound and contour images,
+                         stored as self.dtype and normalized in place, a
+                         ByteRows over the raw pixels if dtype is uint8, or a
+                         splitdata.SplitData if contour_format is 'sparse'
+                self.m: the mean of XC
+                self.s: the sd of XC
+                self.total, self.sqtotal: the column sums and sums of squares
+                         of the unnormalized data, which m and s come from
+                self.height: the height of the ultrasound image roi
+                self.width: the width of the ultrasound image roi
+                self.continds: the non-zero elements of contimgs
+        '''
+        import cv
+        from scipy.misc import imresize
+        # figure out what ROI to use
+        top, bottom, left, right = self.getROI()
             
         scale = 0.1
         #get height and width
@@ -197,10 +444,13 @@ class Loader:
         img = np.asarray(img)
         cropped = img[top:bottom, left:right]
         cheight, cwidth = cropped.shape
-        self.height = np.floor(cheight * scale).astype(np.int)
-        self.width = np.floor(cwidth * scale).astype(np.int)
+        if self.shape is not None:
+            self.height, self.width = self.shape
+        else:
+            self.height = np.floor(cheight * scale).astype(np.int)
+            self.width = np.floor(cwidth * scale).astype(np.int)
 
-        if self.continds == None:
+        if self.continds is None:
             continds = np.arange(self.height*self.width)
             mask = np.zeros((self.height, self.width)).astype(np.bool)
             for i in range(len(self.contimgs)):
@@ -210,13 +460,28 @@ class Loader:
             mask = mask.reshape((self.height*self.width,))
             self.continds = continds[mask]
         
-        XC = np.zeros((len(self.contfiles), self.height*self.width+len(self.continds)))
+        sparse = (self.contour_format == 'sparse')
+        if sparse and self.dtype == np.uint8:
+            raise ValueError("uint8 storage can't be used with sparse contours")
+        n_pixels = self.height*self.width
+        if sparse:
+            # only the ultrasound part is dense, the contour part is collected
+            # as the values, column indices and row pointers of a CSR matrix
+            XC = np.zeros((len(self.contfiles), n_pixels), dtype=self.dtype)
+            values = []
+            indices = []
+            indptr = [0]
+        else:
+            XC = np.zeros((len(self.contfiles), n_pixels+len(self.continds)),
+                    dtype=self.dtype)
+        # the statistics are accumulated in the same pass that fills XC, so only
+        # one full-size copy of the data is ever held in memory
+        total = np.zeros((n_pixels+len(self.continds),))
+        sqtotal = np.zeros((n_pixels+len(self.continds),))
         for i in range(len(self.contfiles)):
             img = cv.LoadImageM(self.contfiles[i], iscolor=False)
             img = np.asarray(img)
-            cropped = img[top:bottom, left:right]
-            resized = imresize(cropped, (self.height, self.width), interp='bicubic') 
-            scaled = np.double(resized)/255
+            ultrasound = self.scaleImage(img, (top, bottom, left, right))
             
             cont = imresize(self.contimgs[i], (self.height, self.width), interp='bicubic')
             cont = np.double(cont)/255
@@ -225,19 +490,71 @@ class Loader:
             cont = cont / s
             cont[cont<0] = 0.
             
-            ultrasound = scaled.reshape((self.height*self.width,))
             contour = cont.reshape((self.height*self.width,))[self.continds]
             
-            XC[i,:] = np.concatenate([ultrasound, contour])
+            if sparse:
+                # the statistics are those of the data as stored
+                contour[contour<0.01] = 0.
+            row = np.concatenate([ultrasound, contour])
+            if sparse:
+                nz = np.nonzero(contour)[0]
+                values.append(contour[nz])
+                indices.append(nz)
+                indptr.append(indptr[-1] + len(nz))
+                XC[i,:] = ultrasound
+            elif self.dtype == np.uint8:
+                XC[i,:] = np.round(row*255)
+                row = XC[i,:]/255.
+            else:
+                XC[i,:] = row
+            total += row
+            sqtotal += row*row
         
-        if self.m == None:    
-            self.m = np.mean(XC, axis=0)
-            self.s = np.std(XC, axis=0)
+        self.total = total
+        self.sqtotal = sqtotal
+        if self.m is None:
+            n = float(XC.shape[0])
+            self.m = total/n
+            self.s = np.sqrt(np.maximum(sqtotal/n - self.m**2, 0.))
             self.s[self.s<0.001] = 1.
-        if sigmoid == False:
-            self.XC = (XC-self.m)/self.s  
-        else:
-            self.XC = XC
+        self.sigmoid = sigmoid
+        if (sigmoid == False) and (self.dtype != np.uint8):
+            # normalize in place, (XC-m)/s would make two more full-size copies
+            XC -= self.m[:XC.shape[1]]
+            XC /= self.s[:XC.shape[1]]
+        if sparse:
+            import scipy.sparse
+            values = np.concatenate(values).astype(np.float32)
+            indices = np.concatenate(indices)
+            offset = None
+            if sigmoid == False:
+                # the contour zeros stay zeros: the sparse part is only scaled,
+                # and the mean is subtracted in SplitData's products
+                values /= self.s[n_pixels:][indices]
+                offset = self.m[n_pixels:]/self.s[n_pixels:]
+            contours = scipy.sparse.csr_matrix((values, indices, indptr),
+                    shape=(len(self.contfiles), len(self.continds)))
+            XC = splitdata.SplitData(XC, contours, offset)
+        elif self.dtype == np.uint8:
+            if sigmoid == False:
+                XC = ByteRows(XC, self.m.astype(np.float32), self.s.astype(np.float32))
+            else:
+                XC = ByteRows(XC)
+        self.XC = XC
+
+    def getRows(self, inds=None):
+        ''' Returns rows of XC ready for training, as an array
+
+            args:
+                array inds: the rows to return, default all rows
+            returns:
+                array X:    the selected rows of the data set
+        '''
+        if inds is None:
+            if isinstance(self.XC, ByteRows):
+                return np.asarray(self.XC)
+            return self.XC
+        return self.XC[inds]
 
     def k_fold_cross_validation(self, X, K):        
         for k in xrange(K):
@@ -280,15 +597,12 @@ class Loader:
         self.combineUltrasoundAndContourImages(sigmoid=sigmoid_1st_layer)
 
 
-    def heat_map(self, makefig=True):
-        self.loadContours()
-        self.cleanContours()
-        self.makeContourImages()
-        heatmap = np.zeros((29,32))
-        for i in range(len(self.contimgs)):
-            scaled = imresize(self.contimgs[i], (29,32), interp='bicubic')
-            heatmap += scaled
-        self.heatmap = np.double(heatmap)/np.max(heatmap)
+    def heat_map(self, makefig=True, shape=(29,32)):
+        ''' Computes self.heatmap with scanContours, and saves it as
+            heatmap.jpg if makefig is True
+        '''
+        self.scanContours(shape)
+        heatmap = self.heatmap
         if makefig:
             import pylab 
             import matplotlib.cm as cm
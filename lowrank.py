@@ -0,0 +1,150 @@
+import numpy as np
+import inference
+
+def factorize(W, rank):
+    '''
+    Splits W (n_visible, n_hidden) into the truncated SVD factors A (n_visible,
+    rank) and B (rank, n_hidden), with the singular values shared evenly
+    between them, so that dot(A, B) is the best rank approximation of W.
+    '''
+    U, S, Vt = np.linalg.svd(np.asarray(W, dtype=np.float64), full_matrices=False)
+    root = np.sqrt(S[:rank])
+    return U[:, :rank]*root, root[:, np.newaxis]*Vt[:rank]
+
+def max_rank(n_visible, n_hidden):
+    '''
+    returns the largest rank at which the two factors of a layer need fewer
+    multiplications than the dense weights
+    '''
+    return (n_visible*n_hidden - 1)/(n_visible + n_hidden)
+
+def energy_rank(W, energy):
+    '''
+    returns the smallest rank whose singular values keep the given fraction of
+    the squared singular values (the energy) of W
+    '''
+    S = np.linalg.svd(np.asarray(W, dtype=np.float64), compute_uv=False)
+    kept = np.cumsum(np.square(S))/np.sum(np.square(S))
+    return int(np.searchsorted(kept, energy)) + 1
+
+def accuracy_rank(layer, X, tolerance):
+    '''
+    Finds the smallest rank at which the output of the factorized layer on X
+    is within tolerance of the output of the dense layer, as the norm of the
+    difference relative to the norm of the dense output.
+
+    args:
+        obj layer:          an InferenceLayer
+        array X:            sample input to the layer
+        float tolerance:    the relative error allowed
+    returns:
+        int rank:           the rank, or None if even max_rank isn't enough
+    '''
+    full = layer.prop_up(X)
+    norm = max(np.linalg.norm(full), 1e-12)
+    U, S, Vt = np.linalg.svd(np.asarray(layer.W, dtype=np.float64), full_matrices=False)
+    def error(rank):
+        root = np.sqrt(S[:rank])
+        out = factorized_layers(U[:, :rank]*root, root[:, np.newaxis]*Vt[:rank],
+                layer.hbias, layer.hidtype, layer.W.dtype)
+        hid = X
+        for l in out:
+            hid = l.prop_up(hid)
+        return np.linalg.norm(hid - full)/norm
+    lo = 1
+    hi = min(max_rank(layer.n_visible, layer.n_hidden), len(S))
+    if hi < 1 or error(hi) > tolerance:
+        return None
+    # the error shrinks as the rank grows, so bisect for the smallest rank
+    while lo < hi:
+        mid = (lo + hi)/2
+        if error(mid) <= tolerance:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def factorized_layers(A, B, hbias, hidtype, dtype=np.float32):
+    '''
+    Makes the two InferenceLayers that replace a factorized layer: a linear
+    bottleneck with weights A and no bias, then the output with weights B and
+    the layer's bias and activation
+    '''
+    bottleneck = inference.InferenceLayer(A, np.zeros((A.shape[1],)), 'gaussian', dtype)
+    return [bottleneck, inference.InferenceLayer(B, hbias, hidtype, dtype)]
+
+def compress_network(network, energy=0.99, X=None, tolerance=None, layers=None,
+        dtype=np.float32):
+    '''
+    Replaces the weights of chosen layers of a trained network with truncated
+    SVD factors, so each of them runs as two thin matrix products. The rank of
+    each layer is the smallest that keeps the energy fraction of its singular
+    values or, if X and tolerance are given, the smallest whose output on X
+    is within tolerance of the dense layer (see accuracy_rank). Layers where
+    that rank would not save any work are left dense.
+
+    To recover accuracy, fine-tune the result with backprop:
+
+        layers = lowrank.compress_network(nn.network, 0.95)
+        mlp = backprop.NeuralNet(network=lowrank.to_backprop(layers))
+        mlp.train(mlp.network, X, X, max_iter=5, initialfit=0,
+                validErrFunc='reconstruction', targetCost='linSquaredErr')
+        layers = inference.export_network(mlp.network)
+
+    args:
+        list[obj] network:  the trained layers, from a DeepNet or NeuralNet
+        float energy:       the fraction of squared singular values to keep
+        array X:            sample input to the network for the accuracy target
+        float tolerance:    the relative output error allowed in each layer
+        list[int] layers:   the layers to compress, default all of them
+        dtype dtype:        the type of the weights, default float32
+    returns:
+        list[InferenceLayer] layers: the network, with two layers in place of
+                            each compressed one
+    '''
+    dense = inference.export_network(network, dtype)
+    if layers is None:
+        layers = range(len(dense))
+    out = []
+    hid = X
+    for i in range(len(dense)):
+        layer = dense[i]
+        rank = None
+        if i in layers:
+            if (X is not None) and (tolerance is not None):
+                rank = accuracy_rank(layer, hid, tolerance)
+            else:
+                rank = energy_rank(layer.W, energy)
+                if rank > max_rank(layer.n_visible, layer.n_hidden):
+                    rank = None
+        if rank is None:
+            out.append(layer)
+            print "layer %d: kept dense, %d weights" % (i+1, layer.W.size)
+        else:
+            A, B = factorize(layer.W, rank)
+            out.extend(factorized_layers(A, B, layer.hbias, layer.hidtype, dtype))
+            print "layer %d: rank %d of %d, %d -> %d weights" % (i+1, rank,
+                    min(layer.W.shape), layer.W.size, A.size + B.size)
+        if hid is not None:
+            hid = layer.prop_up(np.asarray(hid, dtype=dtype))
+    return out
+
+def to_backprop(layers):
+    '''
+    Converts InferenceLayers, e.g. from compress_network, into backprop.Layers
+    that NeuralNet can fine-tune. The bottleneck layers stay linear.
+    '''
+    import backprop
+    return [backprop.Layer(l.W.T, l.hbias, l.n_hidden, l.hidtype) for l in layers]
+
+
+if __name__ == "__main__":
+    import cPickle as pickle
+    import quantize
+    network = pickle.load(file('network.pkl', 'rb'))
+    data = np.load('scaled_images.npy')
+    data = np.asarray(data, dtype='float32')
+    data /= 255.0
+    layers = compress_network(network, X=data[:1000], tolerance=0.01)
+    quantize.verify_quantized(network, layers, data)
+    inference.save_network(layers, 'network_lowrank.npz')
@@ -0,0 +1,190 @@
+import numpy as np
+
+def free_memory():
+    '''
+    Returns the bytes of memory available to new allocations on this machine,
+    from /proc/meminfo, or None if it can't be found out
+    '''
+    try:
+        lines = open('/proc/meminfo', 'r').readlines()
+    except IOError:
+        return None
+    info = {}
+    for line in lines:
+        cells = line.split()
+        if len(cells) >= 2:
+            info[cells[0].rstrip(':')] = int(cells[1])*1024
+    if 'MemAvailable' in info:
+        return info['MemAvailable']
+    if 'MemFree' in info:
+        return info['MemFree'] + info.get('Cached', 0)
+    return None
+
+_on_gpu = None
+
+def on_gpu():
+    '''
+    Returns whether gnumpy runs on a gpu (cudamat) rather than on the cpu
+    (npmat). Imports gnumpy; False if it can't be imported.
+    '''
+    global _on_gpu
+    if _on_gpu is None:
+        import lazy
+        try:
+            backend = getattr(lazy.gnumpy, '_cudamat', None)
+        except ImportError:
+            _on_gpu = False
+            return _on_gpu
+        if backend is not None:
+            _on_gpu = 'npmat' not in getattr(backend, '__name__', '')
+        else:
+            _on_gpu = getattr(lazy.gnumpy, '_useGpu', 'yes') != 'no'
+    return _on_gpu
+
+class MemoryPlanner(object):
+    '''
+    Sizes data chunks, inference blocks and training batches from the layer
+    shapes so that they fit in a memory budget. Used by RBM.train,
+    DeepNet.get_activation, NeuralNet.get_activation and NeuralNet.train.
+
+    args:
+        int budget:         bytes that may be used at once. By default
+                            80000000 elements (the old gpu array limit) for
+                            gnumpy arrays on a gpu, whose memory isn't
+                            measured, and otherwise a fraction of the free
+                            host memory, found out once. Set it explicitly
+                            to use more of a gpu's memory.
+        dtype dtype:        the type of the arrays, default float32
+        float fraction:     the fraction of free memory to use when budget is
+                            None, default 0.5
+        int max_block:      the most rows run through a layer at once during
+                            inference, default 16384
+    '''
+    def __init__(self, budget=None, dtype=np.float32, fraction=0.5, max_block=16384):
+        self.budget = budget
+        self.itemsize = np.dtype(dtype).itemsize
+        self.fraction = fraction
+        self.max_block = max_block
+        self.host_budget = None
+
+    def get_budget(self, device=True):
+        '''
+        returns the memory budget in bytes, for gnumpy arrays if device is
+        True or for numpy arrays otherwise
+        '''
+        if self.budget is not None:
+            return self.budget
+        if device and on_gpu():
+            return 80000000*self.itemsize
+        if self.host_budget is None:
+            # measured once, so the sizes don't change from call to call
+            free = free_memory()
+            if free is None:
+                self.host_budget = 80000000*self.itemsize
+            else:
+                self.host_budget = int(free*self.fraction)
+        return self.host_budget
+
+    def _rows(self, fixed, per_row, n_rows, multiple=1, minimum=1, device=True):
+        # the number of rows that fit in the budget after the fixed cost
+        avail = self.get_budget(device) - fixed*self.itemsize
+        rows = int(avail / max(per_row*self.itemsize, 1))
+        rows = min(rows, n_rows)
+        if multiple > 1 and rows < n_rows:
+            rows = (rows/multiple)*multiple
+        return max(rows, minimum, 1)
+
+    def chunk_rows(self, n_rows, n_visible, n_hidden, batch_size, hidden=False):
+        '''
+        The number of training rows RBM.train moves to the device at once.
+
+        args:
+            int n_rows:     the number of training rows
+            int n_visible:  the number of visible units
+            int n_hidden:   the number of hidden units
+            int batch_size: the RBM batch size
+            bool hidden:    whether hidden targets are chunked along with the data
+        returns:
+            int rows:       a multiple of batch_size, at most n_rows
+        '''
+        # weights, their updates and a temporary, plus the batch activations
+        fixed = 3*n_visible*n_hidden + 4*batch_size*(n_visible + n_hidden)
+        per_row = n_visible
+        if hidden:
+            per_row += n_hidden
+        return self._rows(fixed, per_row, n_rows, batch_size, batch_size)
+
+    def block_rows(self, n_visible, n_hidden, n_rows, device=True):
+        '''
+        The number of rows to run through a layer at once during inference.
+
+        args:
+            int n_visible:  the width of the layer input
+            int n_hidden:   the width of the layer output
+            int n_rows:     the number of rows to run
+            bool device:    whether the layer runs on gnumpy, default True,
+                            or on numpy
+        returns:
+            int rows:       at most n_rows and max_block
+        '''
+        # the input block, the activation and its nonlinearity
+        fixed = n_visible*n_hidden + n_hidden
+        per_row = n_visible + 2*n_hidden
+        return self._rows(fixed, per_row, min(n_rows, self.max_block), device=device)
+
+    def batch_size(self, layer_sizes, n_rows, preferred=1024):
+        '''
+        The backprop batch size for NeuralNet.train: the preferred size unless
+        a batch that large won't fit, but never less than 128 rows. Raises
+        MemoryError if the CG vectors alone don't fit in host memory.
+
+        args:
+            list[int] layer_sizes: the width of the input and of every layer
+            int n_rows:     the number of training rows
+            int preferred:  the batch size to use if it fits, default 1024
+        returns:
+            int batch_size
+        '''
+        n_params = 0
+        for i in range(len(layer_sizes)-1):
+            n_params += (layer_sizes[i] + 1)*layer_sizes[i+1]
+        # CG keeps several float64 copies of the flattened weights in host
+        # memory, whatever the batch size
+        cg = 8*n_params*8/self.itemsize
+        if cg*self.itemsize > self.get_budget(device=False):
+            raise MemoryError("CG needs %d bytes of host memory for %d weights"
+                    % (cg*self.itemsize, n_params))
+        # the weights and their gradient on the device
+        fixed = 2*n_params
+        if not on_gpu():
+            # the device is the host, so the CG vectors share its budget
+            fixed += cg
+        # the activations of every layer and the backpropagated errors
+        per_row = 2*sum(layer_sizes) + 2*max(layer_sizes)
+        # CG on batches much smaller than this is not worth doing
+        minimum = min(128, n_rows, preferred)
+        return self._rows(fixed, per_row, min(n_rows, preferred), minimum=minimum)
+
+_default = None
+
+def default_planner():
+    '''
+    returns the planner used when none is given
+    '''
+    global _default
+    if _default is None:
+        _default = MemoryPlanner()
+    return _default
+
+def set_default_planner(planner):
+    '''
+    Sets the planner used when none is given, e.g.
+        memplan.set_default_planner(memplan.MemoryPlanner(budget=2*1024**3))
+    '''
+    global _default
+    _default = planner
+
+def get_planner(planner=None):
+    if planner is None:
+        return default_planner()
+    return planner
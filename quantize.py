@@ -0,0 +1,147 @@
+import numpy as np
+import inference
+
+class QuantizedLayer(object):
+    '''
+    An inference layer whose weights are stored as float16, or as int8 with a
+    float32 scale for each hidden unit. The weights are turned back into
+    float32 a block of hidden units at a time while running, so the full
+    precision matrix is never held in memory.
+
+    args:
+        array W:        the quantized weights, shape (n_visible, n_hidden)
+        array hbias:    the bias weights for the hidden layer
+        string hidtype: the activation function "sigmoid" or "gaussian"
+        array scale:    the scale of each hidden unit for int8 weights
+        int block:      the number of hidden units dequantized at once
+    '''
+    def __init__(self, W, hbias, hidtype, scale=None, block=512):
+        self.W = W
+        self.hbias = np.asarray(hbias, dtype=np.float32).reshape((-1,))
+        self.scale = scale
+        self.n_visible, self.n_hidden = W.shape
+        self.hidtype = hidtype
+        self.block = block
+
+    def nbytes(self):
+        n = self.W.nbytes + self.hbias.nbytes
+        if self.scale is not None:
+            n += self.scale.nbytes
+        return n
+
+    def prop_up(self, data):
+        data = np.asarray(data, dtype=np.float32)
+        hid = np.zeros((data.shape[0], self.n_hidden), dtype=np.float32)
+        for s in range(0, self.n_hidden, self.block):
+            e = min(s + self.block, self.n_hidden)
+            hid[:, s:e] = np.dot(data, self.W[:, s:e].astype(np.float32))
+            if self.scale is not None:
+                hid[:, s:e] *= self.scale[s:e]
+        hid += self.hbias
+        if self.hidtype == 'sigmoid':
+            np.negative(hid, hid)
+            np.exp(hid, hid)
+            hid += 1.
+            np.reciprocal(hid, hid)
+        return hid
+
+def quantize_network(network, mode='int8'):
+    '''
+    Quantizes the weights of a trained network for deployment.
+
+    args:
+        list[obj] network:  the trained layers, from a DeepNet or NeuralNet
+        string mode:        'float16', or 'int8' for symmetric int8 weights
+                            with one scale per hidden unit
+    returns:
+        list[QuantizedLayer] layers: the quantized network
+    '''
+    assert mode in ('float16', 'int8')
+    layers = []
+    for layer in inference.export_network(network):
+        if mode == 'float16':
+            layers.append(QuantizedLayer(layer.W.astype(np.float16), layer.hbias,
+                layer.hidtype))
+        else:
+            scale = np.max(np.abs(layer.W), axis=0) / 127.
+            scale[scale == 0] = 1.
+            Wq = np.clip(np.round(layer.W / scale), -127, 127).astype(np.int8)
+            layers.append(QuantizedLayer(Wq, layer.hbias, layer.hidtype,
+                scale.astype(np.float32)))
+    return layers
+
+def save_quantized(layers, filename):
+    '''
+    Saves a quantized network to a .npz file, using the same names as
+    autoencoder.save_net_as_mat: W1, b1, hidtype1, ... plus scale1, ... for
+    int8 weights
+    '''
+    mdic = {}
+    for i in range(len(layers)):
+        mdic['W%d'%(i+1)] = layers[i].W
+        mdic['b%d'%(i+1)] = layers[i].hbias
+        mdic['hidtype%d'%(i+1)] = layers[i].hidtype
+        if layers[i].scale is not None:
+            mdic['scale%d'%(i+1)] = layers[i].scale
+    np.savez(filename, **mdic)
+
+def load_quantized(filename):
+    '''
+    Loads a network saved by save_quantized
+    '''
+    mdic = np.load(filename)
+    layers = []
+    i = 1
+    while ('W%d'%i) in mdic:
+        scale = None
+        if ('scale%d'%i) in mdic:
+            scale = mdic['scale%d'%i]
+        layers.append(QuantizedLayer(mdic['W%d'%i], mdic['b%d'%i],
+            str(mdic['hidtype%d'%i]), scale))
+        i += 1
+    return layers
+
+def verify_quantized(network, layers, X, T=None, block=1024):
+    '''
+    Compares a quantized network against the full precision network it came
+    from on held-out data.
+
+    args:
+        list[obj] network:  the full precision network
+        list[obj] layers:   the quantized network
+        array X:            the held-out data
+        array T:            the held-out targets, default X (autoencoders)
+        int block:          the number of rows run at once
+    returns:
+        dict report:        the reconstruction error (as in NeuralNet.getError)
+                            of both networks, the largest and mean absolute
+                            output difference, and the weight sizes in bytes
+    '''
+    if T is None:
+        T = X
+    full = inference.export_network(network)
+    out = inference.run_network(full, X, block)
+    qout = inference.run_network(layers, X, block)
+    T = np.asarray(T)
+    report = {'error': np.mean(np.sqrt(np.sum(np.square(out - T), axis=1))),
+            'quantized_error': np.mean(np.sqrt(np.sum(np.square(qout - T), axis=1))),
+            'max_diff': np.max(np.abs(out - qout)),
+            'mean_diff': np.mean(np.abs(out - qout)),
+            'bytes': sum([l.W.nbytes + l.hbias.nbytes for l in full]),
+            'quantized_bytes': sum([l.nbytes() for l in layers])}
+    print "error: %4.4f, quantized error: %4.4f, max output diff: %4.4f" % \
+            (report['error'], report['quantized_error'], report['max_diff'])
+    print "weights: %d bytes, quantized: %d bytes" % (report['bytes'],
+            report['quantized_bytes'])
+    return report
+
+
+if __name__ == "__main__":
+    import cPickle as pickle
+    network = pickle.load(file('network.pkl', 'rb'))
+    data = np.load('scaled_images.npy')
+    data = np.asarray(data, dtype='float32')
+    data /= 255.0
+    layers = quantize_network(network, 'int8')
+    verify_quantized(network, layers, data)
+    save_quantized(layers, 'network_int8.npz')
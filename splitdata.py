@@ -0,0 +1,146 @@
+import numpy as np
+
+class SplitData(object):
+    '''
+    A data set whose rows are a dense block followed by a sparse block, e.g.
+    the rows of XC made by Loader with contour_format='sparse': the ultrasound
+    pixels are dense and the contour pixels, which are zero away from the
+    tongue ridge, are kept in a scipy CSR matrix.
+
+    The sparse block holds the raw values divided by the sd. Its normalized
+    values are sparse - offset, where offset is mean/sd, so the normalization
+    is folded into the matrix products instead of filling in the zeros.
+
+    args:
+        array dense:    the dense block, shape (n, n_dense)
+        csr sparse:     the sparse block divided by the sd, shape (n, n_sparse)
+        array offset:   mean/sd of the sparse columns, default zeros (no
+                        normalization)
+
+    methods:
+        dot(array W)
+        sparse_dot(array Wc)
+        sparse_tdot(array H)
+        sq_error(array V)
+        toarray()
+    '''
+    def __init__(self, dense, sparse, offset=None):
+        assert dense.shape[0] == sparse.shape[0]
+        self.dense = dense
+        self.sparse = sparse
+        if offset is None:
+            offset = np.zeros((sparse.shape[1],), dtype=np.float32)
+        self.offset = np.asarray(offset, dtype=np.float32)
+        self.n_dense = dense.shape[1]
+        self.shape = (dense.shape[0], dense.shape[1] + sparse.shape[1])
+        self.size = self.shape[0]*self.shape[1]
+        self.dtype = dense.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            # only whole rows can be selected, e.g. data[inds,:]
+            assert all([k == slice(None) for k in key[1:]])
+            key = key[0]
+        if np.isscalar(key):
+            key = [key]
+        return SplitData(self.dense[key], self.sparse[key], self.offset)
+
+    def __array__(self, dtype=None):
+        out = self.toarray()
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
+
+    def toarray(self):
+        '''
+        returns the normalized rows as one dense array
+        '''
+        out = np.zeros(self.shape, dtype=np.result_type(self.dense.dtype, np.float32))
+        out[:, :self.n_dense] = self.dense
+        out[:, self.n_dense:] = self.sparse.toarray()
+        out[:, self.n_dense:] -= self.offset
+        return out
+
+    def sparse_dot(self, Wc):
+        '''
+        Multiplies the normalized sparse block by the weights of the sparse
+        columns, Wc of shape (n_sparse, n_hidden)
+        '''
+        out = np.asarray(self.sparse.dot(Wc))
+        out -= np.dot(self.offset, Wc)
+        return out
+
+    def sparse_tdot(self, H):
+        '''
+        Multiplies the transpose of the normalized sparse block by H of shape
+        (n, n_hidden), e.g. the hidden activations of the rows
+        '''
+        out = np.asarray(self.sparse.T.dot(H))
+        out -= np.outer(self.offset, H.sum(0))
+        return out
+
+    def sq_error(self, V):
+        '''
+        returns the sum of the squared differences between the normalized rows
+        and V, a dense array of the same shape, without making the rows dense
+        '''
+        nd = self.n_dense
+        err = np.sum(np.square(V[:, :nd] - self.dense))
+        # |R - S|^2 = |R|^2 - 2 R.S + |S|^2, with R the sparse columns of V
+        # moved by the offset, so only the nonzeros of S are visited
+        R = V[:, nd:] + self.offset
+        err += np.sum(np.square(R)) - 2*self.sparse.multiply(R).sum() + \
+                np.sum(np.square(self.sparse.data))
+        return float(err)
+
+    def dot(self, W):
+        '''
+        Multiplies the normalized rows by W of shape (n_visible, n_hidden),
+        using a dense product for the dense block and a sparse one for the rest
+        '''
+        out = np.dot(self.dense, W[:self.n_dense])
+        out += self.sparse_dot(W[self.n_dense:])
+        return out
+
+    def nbytes(self):
+        return self.dense.nbytes + self.sparse.data.nbytes + \
+                self.sparse.indices.nbytes + self.sparse.indptr.nbytes
+
+def from_dense(X, n_dense, m=None, s=None, threshold=0.01):
+    '''
+    Splits a dense data set, e.g. a saved XC, into a SplitData whose columns
+    after n_dense are stored sparse.
+
+    args:
+        array X:            the data set
+        int n_dense:        the number of dense columns
+        array m, s:         the mean and sd X was normalized with, default
+                            None for data that wasn't normalized
+        float threshold:    raw values of the sparse columns below this are
+                            dropped
+    returns:
+        SplitData data
+    '''
+    import scipy.sparse
+    raw = np.asarray(X[:, n_dense:], dtype=np.float32)
+    offset = None
+    if m is not None:
+        mc = np.asarray(m[n_dense:], dtype=np.float32)
+        sc = np.asarray(s[n_dense:], dtype=np.float32)
+        raw = raw*sc + mc
+        offset = mc/sc
+    raw[raw < threshold] = 0.
+    if m is not None:
+        raw /= sc
+    return SplitData(np.asarray(X[:, :n_dense]), scipy.sparse.csr_matrix(raw), offset)
+
+def asarray(data):
+    '''
+    returns data as a dense array, converting SplitData
+    '''
+    if isinstance(data, SplitData):
+        return data.toarray()
+    return data
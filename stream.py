@@ -0,0 +1,275 @@
+import numpy as np
+import os
+import time
+import threading
+import traceback
+import Queue
+import inference
+import contours
+
+class StageStats(object):
+    '''
+    Keeps track of the items processed by a pipeline stage and how long each
+    one took.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy = 0.
+        self.latencies = []
+        self.start = None
+        self.stop = None
+
+    def add(self, n, seconds):
+        if self.start is None:
+            self.start = time.time() - seconds
+        self.stop = time.time()
+        self.count += n
+        self.busy += seconds
+        self.latencies.extend([seconds]*n)
+
+    def summary(self):
+        '''
+        returns:
+            dict summary: items, throughput over the wall time of the stage
+                          and over its busy time (items/sec), and p50/p99
+                          latency in ms
+        '''
+        if self.count == 0:
+            return {'stage': self.name, 'items': 0}
+        lat = np.asarray(self.latencies)*1000.
+        wall = max(self.stop - self.start, 1e-9)
+        return {'stage': self.name, 'items': self.count,
+                'throughput': self.count/wall,
+                'capacity': self.count/max(self.busy, 1e-9),
+                'p50_ms': np.percentile(lat, 50), 'p99_ms': np.percentile(lat, 99)}
+
+class Stage(threading.Thread):
+    '''
+    A pipeline stage which takes items from InQueue, applies func to a batch of
+    them and puts the results on OutQueue. Items are tuples of (frame index,
+    frame name, arrival time, payload), and func maps a list of items to a
+    list of new payloads. A batch is sent to func as soon as it has batch_size
+    items, or max_wait seconds after its first item arrived. None on InQueue
+    stops the stage and is passed on. If func raises, the traceback is kept
+    in error and the rest of the items are taken but dropped, so the stages
+    upstream don't block, until None is passed on as usual.
+
+    args:
+        string name:        the stage name used in reports
+        callable func:      maps a list of items to a list of payloads
+        Queue InQueue:      where items come from
+        Queue OutQueue:     where results go, None for the last stage
+        int batch_size:     the most items given to func at once
+        float max_wait:     how long to wait for a batch to fill, in seconds
+    '''
+    def __init__(self, name, func, InQueue, OutQueue, batch_size=1, max_wait=0.):
+        super(Stage, self).__init__()
+        self.daemon = True
+        self.func = func
+        self.InQueue = InQueue
+        self.OutQueue = OutQueue
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.stats = StageStats(name)
+        self.error = None
+
+    def run(self):
+        flag = 'ok'
+        while (flag != 'stop'):
+            item = self.InQueue.get()
+            if item == None:
+                flag = 'stop'
+                break
+            batch = [item]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.InQueue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if item == None:
+                    flag = 'stop'
+                    break
+                batch.append(item)
+            if self.error is not None:
+                continue
+            start = time.time()
+            try:
+                results = self.func(batch)
+            except Exception:
+                self.error = traceback.format_exc()
+                continue
+            self.stats.add(len(batch), time.time() - start)
+            if self.OutQueue is not None:
+                for (ind, name, t, payload), result in zip(batch, results):
+                    self.OutQueue.put((ind, name, t, result))
+        if self.OutQueue is not None:
+            self.OutQueue.put(None)
+
+def image_dir_source(image_dir, extensions=('.jpg', '.png', '.bmp')):
+    '''
+    Yields (name, image) for the images in a directory, in sorted order
+    '''
+    import cv
+    for name in sorted(os.listdir(image_dir)):
+        if os.path.splitext(name)[1].lower() in extensions:
+            img = cv.LoadImageM(os.path.join(image_dir, name), iscolor=False)
+            yield name, np.asarray(img)
+
+def video_source(filename):
+    '''
+    Yields (frame number, grayscale image) for the frames of a video file
+    '''
+    import cv
+    capture = cv.CaptureFromFile(filename)
+    count = 0
+    frame = cv.QueryFrame(capture)
+    while frame is not None:
+        gray = cv.CreateImage(cv.GetSize(frame), frame.depth, 1)
+        cv.CvtColor(frame, gray, cv.CV_BGR2GRAY)
+        yield count, np.asarray(cv.GetMat(gray))
+        count += 1
+        frame = cv.QueryFrame(capture)
+
+class ContourPipeline(object):
+    '''
+    Extracts tongue contours from a stream of ultrasound frames. Frames go
+    through four stages, each in its own thread and connected by bounded
+    queues:
+
+        preprocess: crop, resize and normalize with the Loader ROI and stats
+        network:    micro-batched inference through the trained network
+        contour:    trace the contour in the contour block of the output
+        sink:       hand each result to the sink
+
+    The contour part of the network input is set to a blank trace, so the
+    network translates the ultrasound image into its contour.
+
+    args:
+        obj loader:         a Loader that has been through loadData, or that
+                            has roi, height, width, continds, m, s and the
+                            contour extents minx, maxx, miny, maxy set
+        list[obj] network:  the trained network (DeepNet or NeuralNet layers)
+        callable sink:      called as sink(name, (x, y)) for each frame with
+                            the trace in image coordinates, default keeps the
+                            results in self.results
+        int n_points:       the number of points in each trace
+        int batch_size:     the most frames run through the network at once
+        float max_wait:     how long the network stage waits to fill a batch
+        float latency_budget: frames slower than this (seconds, end to end)
+                            are counted as late
+        int queue_size:     the length of the queues between stages
+    '''
+    def __init__(self, loader, network, sink=None, n_points=32, batch_size=16,
+            max_wait=0.02, latency_budget=0.1, queue_size=64):
+        self.loader = loader
+        self.layers = inference.export_network(network)
+        self.roi = loader.getROI()
+        self.npix = loader.height*loader.width
+        self.sigmoid = getattr(loader, 'sigmoid', False)
+        self.m = np.asarray(loader.m, dtype=np.float32)
+        self.s = np.asarray(loader.s, dtype=np.float32)
+        # the normalized value of an empty trace
+        if self.sigmoid:
+            self.blank = np.zeros((len(loader.continds),), dtype=np.float32)
+        else:
+            self.blank = -self.m[self.npix:]/self.s[self.npix:]
+        if sink is None:
+            self.results = []
+            sink = lambda name, contour: self.results.append((name, contour))
+        self.sink = sink
+        self.n_points = n_points
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.latency_budget = latency_budget
+        self.queue_size = queue_size
+
+    def preprocess(self, items):
+        rows = []
+        for ind, name, t, img in items:
+            row = np.concatenate([self.loader.scaleImage(img, self.roi),
+                self.blank]).astype(np.float32)
+            if not self.sigmoid:
+                row[:self.npix] -= self.m[:self.npix]
+                row[:self.npix] /= self.s[:self.npix]
+            rows.append(row)
+        return rows
+
+    def run_network(self, items):
+        rows = [row for ind, name, t, row in items]
+        out = inference.run_network(self.layers, np.vstack(rows), block=len(rows))
+        return [row for row in out]
+
+    def extract_contours(self, items):
+        out = np.vstack([row for ind, name, t, row in items])
+        x, y = contours.extract_contours(out, self.loader, self.n_points)
+        return [(x[i], y[i]) for i in range(x.shape[0])]
+
+    def write(self, items):
+        for ind, name, t, contour in items:
+            self.sink(name, contour)
+            self.latencies.append(time.time() - t)
+        return items
+
+    def run(self, source, max_frames=None):
+        '''
+        Runs the frames from source through the pipeline.
+
+        args:
+            iterable source:    yields (name, image), e.g. image_dir_source or
+                                video_source
+            int max_frames:     stop after this many frames
+        returns:
+            dict report:        the stage summaries, end to end latency and the
+                                number of frames over the latency budget
+        raises:
+            RuntimeError:       with the traceback if a stage failed
+        '''
+        queues = [Queue.Queue(self.queue_size) for i in range(4)]
+        stages = [Stage('preprocess', self.preprocess, queues[0], queues[1]),
+                Stage('network', self.run_network, queues[1], queues[2],
+                    self.batch_size, self.max_wait),
+                Stage('contour', self.extract_contours, queues[2], queues[3],
+                    self.batch_size),
+                Stage('sink', self.write, queues[3], None, self.batch_size)]
+        self.latencies = []
+        for stage in stages:
+            stage.start()
+
+        start = time.time()
+        source_stats = StageStats('source')
+        count = 0
+        frames = iter(source)
+        while (max_frames is None) or (count < max_frames):
+            if any([stage.error is not None for stage in stages]):
+                break
+            t = time.time()
+            try:
+                name, img = next(frames)
+            except StopIteration:
+                break
+            source_stats.add(1, time.time() - t)
+            queues[0].put((count, name, time.time(), img))
+            count += 1
+        queues[0].put(None)
+        for stage in stages:
+            stage.join()
+        wall = time.time() - start
+        for stage in stages:
+            if stage.error is not None:
+                raise RuntimeError("stage %s failed:\n%s" % (stage.stats.name,
+                    stage.error))
+
+        report = {'frames': count, 'fps': count/max(wall, 1e-9),
+                'stages': [source_stats.summary()] +
+                    [stage.stats.summary() for stage in stages]}
+        if len(self.latencies) > 0:
+            lat = np.asarray(self.latencies)*1000.
+            report['p50_ms'] = np.percentile(lat, 50)
+            report['p99_ms'] = np.percentile(lat, 99)
+            report['late'] = int(np.sum(lat > self.latency_budget*1000.))
+        return report
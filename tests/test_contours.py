@@ -0,0 +1,61 @@
+'''
+Checks that contours.extract_contours recovers known traces from the contour
+images that makeContourImages draws for them, through the same normalized
+rows of XC a trained network would output.
+
+    python tests/test_contours.py
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import benchmark
+import contours
+import loadData
+
+class ContoursTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp()
+        benchmark.make_synthetic_subject(cls.data_dir, 20)
+        cls.loader = loadData.Loader(cls.data_dir, num_threads=1)
+        cls.loader.loadData()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir)
+
+    def test_round_trip(self):
+        l = self.loader
+        x, y = contours.extract_contours(l.XC, l)
+        self.assertEqual(x.shape, l.contx.shape)
+        # the size in image pixels of a cell of the contour grid
+        cellx = (l.maxx - l.minx + 1)/float(l.width)
+        celly = (l.maxy - l.miny + 1)/float(l.height)
+        # every trace is found and covers most of the traced columns; the
+        # ridges fade out at the ends of the traces
+        self.assertTrue(np.all(x[:, 0] > 0))
+        overlap = np.minimum(x[:, -1], l.contx[:, -1]) - \
+                np.maximum(x[:, 0], l.contx[:, 0])
+        self.assertTrue(np.all(overlap > 0.8*(l.contx[:, -1] - l.contx[:, 0])))
+        # and lies within a cell of the trace
+        msd = contours.mean_sum_of_distances(x, y, l.contx, l.conty)
+        self.assertTrue(np.all(msd < max(cellx, celly)),
+                "mean sum of distances %s" % msd)
+
+    def test_write_contours(self):
+        l = self.loader
+        x, y = contours.extract_contours(l.XC, l)
+        filename = os.path.join(self.data_dir, 'extracted.csv')
+        contours.write_contours(filename, l.contfiles, x, y)
+        lines = open(filename).readlines()
+        self.assertEqual(len(lines), len(l.contfiles) + 1)
+        cells = lines[1].rstrip('\n').split('\t')
+        self.assertEqual(len(cells), 1 + 2*x.shape[1])
+        self.assertEqual(int(cells[1]), int(np.round(x[0, 0])))
+
+if __name__ == '__main__':
+    unittest.main()
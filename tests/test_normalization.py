@@ -0,0 +1,78 @@
+'''
+Checks that the compact forms of XC, ByteRows (dtype=np.uint8) and
+splitdata.SplitData (contour_format='sparse'), give the same normalized rows
+and products as the dense float32 XC of the same subject.
+
+    python tests/test_normalization.py
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import benchmark
+import loadData
+import splitdata
+
+class NormalizationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp()
+        benchmark.make_synthetic_subject(cls.data_dir, 40)
+        cls.dense = loadData.Loader(cls.data_dir, num_threads=1)
+        cls.dense.loadData()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir)
+
+    def load(self, **kwargs):
+        l = loadData.Loader(self.data_dir, num_threads=1,
+                continds=self.dense.continds, **kwargs)
+        l.loadData()
+        return l
+
+    def test_byterows(self):
+        l = self.load(dtype=np.uint8)
+        self.assertTrue(isinstance(l.XC, loadData.ByteRows))
+        self.assertEqual(l.XC.shape, self.dense.XC.shape)
+        self.assertTrue(np.allclose(l.m, self.dense.m, atol=1e-5))
+        self.assertTrue(np.allclose(l.s, self.dense.s, atol=1e-5))
+        X = self.dense.XC
+        self.assertTrue(np.allclose(np.asarray(l.XC), X, atol=1e-4))
+        self.assertTrue(np.allclose(l.XC[5:9], X[5:9], atol=1e-4))
+        self.assertTrue(np.allclose(l.XC[[7, 2]], X[[7, 2]], atol=1e-4))
+        self.assertTrue(np.allclose(l.XC[3, :10], X[3, :10], atol=1e-4))
+
+    def test_splitdata(self):
+        l = self.load(contour_format='sparse')
+        self.assertTrue(isinstance(l.XC, splitdata.SplitData))
+        self.assertEqual(l.XC.shape, self.dense.XC.shape)
+        # the sparse contours drop values below 0.01, so the reference is the
+        # dense data with them dropped, normalized the way Loader does
+        X = self.dense.XC*self.dense.s + self.dense.m
+        nd = l.XC.n_dense
+        X[:, nd:][X[:, nd:] < 0.01] = 0.
+        m = X.mean(0)
+        s = X.std(0)
+        s[s < 0.001] = 1.
+        self.assertTrue(np.allclose(l.m, m, atol=1e-5))
+        self.assertTrue(np.allclose(l.s, s, atol=1e-5))
+        X = (X - m)/s
+        self.assertTrue(np.allclose(l.XC.toarray(), X, atol=1e-4))
+        self.assertTrue(np.allclose(l.XC[10:20].toarray(), X[10:20], atol=1e-4))
+        # the products fold the normalization of the sparse columns in
+        rng = np.random.RandomState(0)
+        W = rng.randn(X.shape[1], 5).astype(np.float32)
+        self.assertTrue(np.allclose(l.XC.dot(W), np.dot(X, W), atol=1e-2))
+        H = rng.rand(X.shape[0], 5)
+        self.assertTrue(np.allclose(l.XC.sparse_tdot(H),
+            np.dot(X[:, nd:].T, H), atol=1e-2))
+        V = rng.randn(*X.shape)
+        self.assertAlmostEqual(l.XC.sq_error(V)/V.size,
+                np.sum(np.square(V - X))/V.size, places=4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+'''
+Checks the tied-weight autoencoder: NeuralNet keeps decoder layers tied to the
+encoder, so CG optimizes half the weights, and the gradient of the tied
+weights matches finite differences.
+
+    python tests/test_tied.py
+'''
+import os
+import sys
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import autoencoder
+import backprop
+import deepnet
+
+def make_network(sizes, types):
+    # a small pretrained-looking stack of Holders with random weights
+    rng = np.random.RandomState(0)
+    network = []
+    for i in range(len(sizes)-1):
+        rbm = deepnet.RBM(sizes[i], sizes[i+1], types[i], types[i+1], rng=rng)
+        network.append(deepnet.Holder(rbm))
+    return network
+
+class TiedTest(unittest.TestCase):
+    def setUp(self):
+        self.network = make_network([8, 5, 3], ['sigmoid', 'sigmoid', 'sigmoid'])
+
+    def test_neuralnet_keeps_layers_tied(self):
+        untied = backprop.NeuralNet(network=autoencoder.unroll_network(self.network))
+        tied = backprop.NeuralNet(network=autoencoder.unroll_network(self.network,
+            tied=True))
+        self.assertTrue(isinstance(tied.network[2], backprop.TiedLayer))
+        self.assertTrue(tied.network[2].tied is tied.network[1])
+        self.assertTrue(tied.network[3].tied is tied.network[0])
+        n_untied = len(untied.flatten_weights(untied.network))
+        n_tied = len(tied.flatten_weights(tied.network))
+        # the decoder weights, but not the decoder biases, are dropped
+        self.assertEqual(n_untied - n_tied, 8*5 + 5*3)
+        # the tied network computes the same outputs as the untied one
+        X = np.random.RandomState(1).rand(20, 8)
+        self.assertTrue(np.allclose(untied.run_through_network(X),
+            tied.run_through_network(X), atol=1e-5))
+
+    def test_tied_gradient(self):
+        nn = backprop.NeuralNet(network=autoencoder.unroll_network(self.network,
+            tied=True))
+        X = np.random.RandomState(2).rand(10, 8)
+        # the cost that matches the sigmoid output layer
+        nn.targetCost = 'crossEntropy'
+        weights = np.ones((X.shape[0], 1))
+        v = nn.flatten_weights(nn.network)
+        cost, grad = nn.backprop_gradient(v.copy(), nn.network, X, X, weights)
+        rng = np.random.RandomState(3)
+        eps = 1e-3
+        for i in rng.choice(len(v), 20, replace=False):
+            step = np.zeros_like(v)
+            step[i] = eps
+            up = nn.backprop_gradient(v + step, nn.network, X, X, weights)[0]
+            down = nn.backprop_gradient(v - step, nn.network, X, X, weights)[0]
+            numeric = (up - down)/(2*eps)
+            self.assertTrue(abs(numeric - grad[i]) <= 1e-2*max(abs(numeric), 1e-2),
+                    "weight %d: backprop %g, finite difference %g" % (i, grad[i],
+                        numeric))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import time
+import threading
+import lazy
+
+gp = lazy.gnumpy
+
+# gnumpy keeps its arrays as float32
+ITEMSIZE = 4
+
+class Accounting(object):
+    '''
+    Counts the arrays moved between numpy and gnumpy, and the calls to
+    gp.free_reuse_cache, by call site. Made by enable(); while it is active
+    the epoch, layer and iteration events of RBM, DeepNet and NeuralNet
+    training carry a 'transfers' field with the counts since the previous
+    event of the same name (see fields()).
+
+    variables:
+        dict sites:     'direction call_site' -> {'calls', 'bytes', 'seconds'},
+                        where direction is to_device, to_host, on_device (a
+                        copy of an array already on the gpu) or free_cache
+        int peak:       the most gnumpy memory in use seen so far, in bytes
+
+    The counts are updated under a lock, since DeepNet.train_pipelined trains
+    each layer in its own thread.
+    '''
+    def __init__(self):
+        self.sites = {}
+        self.peak = 0
+        self.marks = {}
+        self.mark_peaks = {}
+        self.lock = threading.Lock()
+
+    def add(self, direction, site, nbytes, seconds):
+        key = '%s %s' % (direction, site)
+        with self.lock:
+            if key not in self.sites:
+                self.sites[key] = {'calls': 0, 'bytes': 0, 'seconds': 0.}
+            entry = self.sites[key]
+            entry['calls'] += 1
+            entry['bytes'] += nbytes
+            entry['seconds'] += seconds
+            self._sample_memory()
+
+    def sample_memory(self):
+        with self.lock:
+            self._sample_memory()
+
+    def _sample_memory(self):
+        # the caller holds the lock
+        used = gp.memory_in_use()
+        self.peak = max(self.peak, used)
+        for mark in self.mark_peaks:
+            self.mark_peaks[mark] = max(self.mark_peaks[mark], used)
+
+    def totals(self, sites=None):
+        '''
+        Sums the counts of every call site by direction
+
+        returns:
+            dict totals:    e.g. to_device_bytes, to_device_calls, to_host_bytes,
+                            free_cache_calls, seconds (the time in transfers)
+        '''
+        if sites is None:
+            with self.lock:
+                sites = dict([(key, dict(entry)) for key, entry in self.sites.items()])
+        totals = {'seconds': 0.}
+        for direction in ('to_device', 'to_host', 'on_device', 'free_cache'):
+            totals[direction + '_bytes'] = 0
+            totals[direction + '_calls'] = 0
+        for key, entry in sites.items():
+            direction = key.split(' ')[0]
+            totals[direction + '_bytes'] += entry['bytes']
+            totals[direction + '_calls'] += entry['calls']
+            totals['seconds'] += entry['seconds']
+        return totals
+
+    def delta(self, mark):
+        '''
+        returns the counts since the last delta with the same mark, with the
+        totals, the counts by site and the peak gnumpy memory in that time
+        '''
+        with self.lock:
+            last = self.marks.get(mark, {})
+            sites = {}
+            for key, entry in self.sites.items():
+                old = last.get(key, {'calls': 0, 'bytes': 0, 'seconds': 0.})
+                if entry['calls'] > old['calls']:
+                    sites[key] = {'calls': entry['calls'] - old['calls'],
+                            'bytes': entry['bytes'] - old['bytes'],
+                            'seconds': entry['seconds'] - old['seconds']}
+            self.marks[mark] = dict([(key, dict(entry))
+                for key, entry in self.sites.items()])
+            peak = self.mark_peaks.get(mark, self.peak)
+            self.mark_peaks[mark] = gp.memory_in_use()
+        out = self.totals(sites)
+        out['sites'] = sites
+        out['peak_bytes'] = peak
+        return out
+
+    def report(self):
+        '''
+        Prints the counts of every call site since enable()
+        '''
+        with self.lock:
+            sites = dict([(key, dict(entry)) for key, entry in self.sites.items()])
+        print "%-40s %8s %14s %10s" % ('transfer', 'calls', 'MB', 'seconds')
+        for key in sorted(sites):
+            entry = sites[key]
+            print "%-40s %8d %14.2f %10.4f" % (key, entry['calls'],
+                    entry['bytes']/1e6, entry['seconds'])
+        print "peak gnumpy memory: %.2f MB" % (self.peak/1e6)
+
+_accounting = None
+
+def enable():
+    '''
+    Starts counting transfers, returns the Accounting
+    '''
+    global _accounting
+    _accounting = Accounting()
+    return _accounting
+
+def disable():
+    '''
+    Stops counting transfers, returns the Accounting so far
+    '''
+    global _accounting
+    accounting = _accounting
+    _accounting = None
+    return accounting
+
+def get_accounting():
+    '''
+    returns the active Accounting, or None if transfers aren't counted
+    '''
+    return _accounting
+
+def fields(mark):
+    '''
+    Extra fields for a training event: {'transfers': the counts since the last
+    event called mark}, or {} if transfers aren't counted
+    '''
+    if _accounting is None:
+        return {}
+    return {'transfers': _accounting.delta(mark)}
+
+def to_device(a, site):
+    '''
+    gp.garray(a), counted under site
+    '''
+    if _accounting is None:
+        return gp.garray(a)
+    start = time.time()
+    g = gp.garray(a)
+    if hasattr(a, 'as_numpy_array'):
+        direction = 'on_device'
+    else:
+        direction = 'to_device'
+    _accounting.add(direction, site, g.size*ITEMSIZE, time.time() - start)
+    return g
+
+def to_host(g, site):
+    '''
+    g.as_numpy_array(), counted under site
+    '''
+    if _accounting is None:
+        return g.as_numpy_array()
+    start = time.time()
+    a = g.as_numpy_array()
+    _accounting.add('to_host', site, g.size*ITEMSIZE, time.time() - start)
+    return a
+
+def free_cache(site):
+    '''
+    gp.free_reuse_cache(), counted under site
+    '''
+    if _accounting is None:
+        gp.free_reuse_cache()
+        return
+    start = time.time()
+    gp.free_reuse_cache()
+    _accounting.add('free_cache', site, 0, time.time() - start)